@@ -2,6 +2,7 @@ usage()
 {
   echo "Usage: $0 [-y /path/to/python/indexing/code] [-d /path/to/kaggle/best/buy/datasets] [-p /path/to/bbuy/products/field/mappings] [-n ] [-a /path/to/bbuy/product annotations/field/mappings] [ -q /path/to/bbuy/queries/field/mappings ] [ -g /path/to/write/logs/to ]"
   echo "if -n is specified, then ONLY annotations indexing (week 2 content) will be done"
+  echo "if -b is specified, products are indexed blue/green: into a new timestamped index that the bbuy_products alias is swapped to once it is complete (see utilities/reindex.py)"
   echo "Synonyms are ONLY applied to the annotation indexing (-n), which is on a reduced set of results"
   echo "Example: ./index-data.sh  -y /Users/grantingersoll/projects/corise/search_ml_instructor/src/main/python/search_ml/week1_finished   -d /Users/grantingersoll/projects/corise/datasets/bbuy -q /Users/grantingersoll/projects/corise/search_ml_instructor/src/main/conf/bbuy_queries.json -p /Users/grantingersoll/projects/corise/search_ml_instructor/src/main/conf/bbuy_products.json -g /tmp"
   exit 2
@@ -14,8 +15,10 @@ DATASETS_DIR="/workspace/datasets"
 PYTHON_LOC="/workspace/search_with_machine_learning_course/week4/utilities" # adjusted for week4 project
 
 LOGS_DIR="/workspace/logs"
+REINDEX="$(cd "$(dirname "$0")" && pwd)/utilities/reindex.py"
 ANNOTATE=""
-while getopts ':p:a:q:g:y:d:hrn' c
+BLUE_GREEN=""
+while getopts ':p:a:q:g:y:d:hrnb' c
 do
   case $c in
     a) ANNOTATIONS_JSON_FILE=$OPTARG ;;
@@ -26,6 +29,7 @@ do
     y) PYTHON_LOC=$OPTARG ;;
     n) ANNOTATE="--annotate" ;;
     r) REDUCE="--reduced" ;;
+    b) BLUE_GREEN="true" ;;
     h) usage ;;
     [?])
       echo "Invalid option: -${OPTARG}"
@@ -41,9 +45,14 @@ echo "Running python scripts from $PYTHON_LOC"
 
 set -x
 
+if [ "$ANNOTATE" != "--annotate" ] && [ "$BLUE_GREEN" == "true" ]; then
+  echo "Reindexing products blue/green with the settings and mappings of $PRODUCTS_JSON_FILE, writing logs to $LOGS_DIR/reindex_products.log"
+  nohup python "$REINDEX" --replace_index -m "$PRODUCTS_JSON_FILE" --indexer "$PYTHON_LOC/index_products.py" -s "$DATASETS_DIR/product_data/products" -- $REDUCE > "$LOGS_DIR/reindex_products.log" 2>&1 &
+fi
+
 if [ "$ANNOTATE" != "--annotate" ]; then
   echo "Creating index settings and mappings"
-  if [ -f $PRODUCTS_JSON_FILE ]; then
+  if [ -f $PRODUCTS_JSON_FILE ] && [ "$BLUE_GREEN" != "true" ]; then
     echo " Product file: $PRODUCTS_JSON_FILE"
     curl -k -X PUT -u admin  "https://localhost:9200/bbuy_products" -H 'Content-Type: application/json' -d "@$PRODUCTS_JSON_FILE"
     if [ $? -ne 0 ] ; then
@@ -0,0 +1,66 @@
+# Embedding backend benchmark: encodes the same product names with each backend of embedding_backends.py (PyTorch,
+# ONNX, ONNX with int8 weights) at the same thread count and reports load time, names/sec and how close the vectors
+# are to the PyTorch ones (the cosine similarity of each name's two vectors).
+# Usage: python bench_embeddings.py -s /workspace/datasets/product_data/products --threads 4
+import click
+import json
+import logging
+from time import perf_counter
+
+import numpy as np
+
+from bench_quantization import load_names
+from embedding_backends import BACKENDS, DEFAULT_ONNX_DIR, ensure_onnx_export, load_encoder
+from embedding_batches import EmbeddingBatches
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+
+@click.command()
+@click.option('--source_dir', '-s', required=True, help="Products XML directory to take the names from")
+@click.option('--max_names', default=5000, show_default=True, help="Distinct product names to encode")
+@click.option('--backend', 'backends', multiple=True, type=click.Choice(BACKENDS), default=BACKENDS, show_default=True, help="Backends to compare (repeatable); torch is the reference")
+@click.option('--threads', default=1, show_default=True, help="Intra-op threads of every backend")
+@click.option('--batch_size', default=64, show_default=True, help="Names per model batch (batched by length, as in the week4 indexer)")
+@click.option('--runs', '-r', default=3, show_default=True, help="Timed runs per backend, after one warm up run; the median is reported")
+@click.option('--onnx_dir', default=DEFAULT_ONNX_DIR, show_default=True, help="Directory of the ONNX export, created if missing")
+@click.option('--output', '-o', default=None, help="Write the results to this JSON file")
+def main(source_dir: str, max_names: int, backends, threads: int, batch_size: int, runs: int, onnx_dir: str, output: str):
+    names = load_names(source_dir, max_names)
+    for backend in backends:
+        ensure_onnx_export(backend, MODEL_NAME, onnx_dir)  # not part of the load time
+    results = {}
+    reference = None
+    for backend in ["torch"] + [backend for backend in backends if backend != "torch"]:
+        start = perf_counter()
+        embedder = EmbeddingBatches(load_encoder(backend, MODEL_NAME, threads, onnx_dir), batch_size)
+        load_seconds = perf_counter() - start
+        vectors = embedder.encode(names)  # warm up
+        seconds = []
+        for _ in range(runs):
+            start = perf_counter()
+            vectors = embedder.encode(names)
+            seconds.append(perf_counter() - start)
+        median = sorted(seconds)[len(seconds) // 2]
+        if reference is None:
+            reference = vectors
+        similarity = np.sum(vectors * reference, axis=1)  # the vectors are normalized
+        results[backend] = {"load_seconds": load_seconds, "names_per_sec": len(names) / median,
+                            "min_cosine_to_torch": float(similarity.min()),
+                            "mean_cosine_to_torch": float(similarity.mean())}
+    for backend, result in results.items():
+        speedup = result["names_per_sec"] / results["torch"]["names_per_sec"]
+        logger.info(f"{backend:>9}: loaded in {result['load_seconds']:.1f}s, {result['names_per_sec']:.0f} names/sec "
+                    f"({speedup:.2f}x torch), cosine to torch min {result['min_cosine_to_torch']:.4f} mean "
+                    f"{result['mean_cosine_to_torch']:.4f}")
+    if output:
+        with open(output, "w") as f:
+            json.dump({"names": len(names), "threads": threads, "batch_size": batch_size, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
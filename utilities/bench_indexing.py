@@ -0,0 +1,163 @@
+# Indexing throughput benchmark: runs index_products.py or index_queries.py against the local fake cluster of
+# fake_bulk_server.py, on sample data or on generated products/queries, and reports docs/sec, CPU time per doc, peak
+# RSS and bulk bytes. Results can be saved and compared with a previous run to catch regressions.
+# Usage: python bench_indexing.py --generate 20000 --runs 3 --indexer_args "-w 4 --raw_bulk" -o after.json -c before.json
+import click
+import csv
+import json
+import logging
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+from fake_bulk_server import start_server
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+UTILITIES_DIR = os.path.dirname(os.path.abspath(__file__))
+CATEGORIES = [("abcat0100000", "TV & Home Theater"), ("abcat0600000", "Movies & Music"), ("abcat0500000", "Computers"),
+              ("abcat0200000", "Audio")]
+QUERIES = ["ipod", "laptop", "tv", "xbox 360", "canon camera", "headphones", "iphone case", "hdmi cable"]
+
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def generate_products(path, products, rng):
+    """Writes a products XML file shaped like the BestBuy dump (the fields of product_xml.mappings that matter for
+    the extraction cost: skus, categories, descriptions of varying length, features)."""
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<products>\n')
+        for _ in range(products):
+            sku = rng.randint(1000000, 9999999)
+            category_id, category = rng.choice(CATEGORIES)
+            leaf = rng.randint(0, 999)
+            f.write("  <product>\n")
+            f.write(f"    <sku>{sku}</sku>\n    <productId>{sku + 7}</productId>\n")
+            f.write(f"    <name>{_escape(rng.choice(QUERIES).title())} model {rng.randint(0, 5000)}</name>\n")
+            f.write(f"    <type>HardGood</type>\n    <startDate>2011-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}</startDate>\n")
+            f.write(f"    <active>{rng.choice(['true', 'false'])}</active>\n")
+            f.write(f"    <regularPrice>{rng.randint(1, 999)}.99</regularPrice>\n    <salePrice>{rng.randint(1, 999)}.49</salePrice>\n")
+            f.write(f"    <onSale>{rng.choice(['true', 'false'])}</onSale>\n    <digital>false</digital>\n")
+            f.write("    <frequentlyPurchasedWith>" + "".join(f"<productId>{rng.randint(1, 99999)}</productId>" for _ in range(rng.randint(0, 3))) + "</frequentlyPurchasedWith>\n")
+            f.write(f"    <salesRankShortTerm>{rng.randint(1, 99999)}</salesRankShortTerm>\n")
+            f.write(f"    <url>http://www.bestbuy.com/site/p/{sku}.p</url>\n")
+            f.write(f"    <categoryPath><category><id>cat00000</id><name>Best Buy</name></category>"
+                    f"<category><id>{category_id}</id><name>{_escape(category)}</name></category>"
+                    f"<category><id>abcat{leaf:07d}</id><name>Leaf {leaf}</name></category></categoryPath>\n")
+            f.write(f"    <customerReviewCount>{rng.randint(0, 500)}</customerReviewCount>\n")
+            f.write(f"    <customerReviewAverage>{rng.randint(10, 50) / 10}</customerReviewAverage>\n")
+            f.write(f"    <onlineAvailability>{rng.choice(['true', 'false'])}</onlineAvailability>\n")
+            f.write(f"    <shortDescription>{' '.join(rng.choice(QUERIES) for _ in range(rng.randint(3, 15)))}</shortDescription>\n")
+            f.write(f"    <manufacturer>Maker {rng.randint(0, 50)}</manufacturer>\n    <modelNumber>M-{sku}</modelNumber>\n")
+            f.write(f"    <image>http://images.bestbuy.com/{sku}.jpg</image>\n    <color>Black</color>\n")
+            f.write(f"    <longDescription>{' '.join('lorem ipsum dolor sit amet' for _ in range(rng.randint(1, 60)))}</longDescription>\n")
+            f.write("    <features>" + "".join(f"<feature>Feature {j}</feature>" for j in range(rng.randint(0, 6))) + "</features>\n")
+            f.write("  </product>\n")
+        f.write("</products>\n")
+
+
+def generate_queries(path, rows, rng):
+    """Writes a train.csv like query log."""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["user", "sku", "category", "query", "click_time", "query_time"])
+        for i in range(rows):
+            minute = f"2011-08-{rng.randint(10, 28)} {rng.randint(10, 23)}:{rng.randint(10, 59)}"
+            writer.writerow([f"u{rng.randint(0, 99999)}", rng.randint(1000000, 9999999), rng.choice(CATEGORIES)[0],
+                             rng.choice(QUERIES), f"{minute}:40.5", f"{minute}:10.2"])
+
+
+def run_indexer(indexer, source, server, indexer_args):
+    """Runs one indexer process against the fake cluster and returns its measurements."""
+    script = "index_products.py" if indexer == "products" else "index_queries.py"
+    env = dict(os.environ, OPENSEARCH_HOST="127.0.0.1", OPENSEARCH_PORT=str(server.server_address[1]),
+               OPENSEARCH_USE_SSL="false")
+    server.stats.reset()
+    start = perf_counter()
+    process = subprocess.Popen([sys.executable, script, "-s", source] + indexer_args, cwd=UTILITIES_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # wait4 gives the usage of the indexer and of the worker processes it reaped, for this run only
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise click.ClickException(f"{script} failed:\n{stderr.decode()[-2000:]}")
+    received = server.stats.as_dict()
+    docs = max(received["docs"], 1)
+    return {
+        "seconds": elapsed,
+        "docs": received["docs"],
+        "docs_per_sec": received["docs"] / elapsed,
+        "cpu_ms_per_doc": 1000 * (usage.ru_utime + usage.ru_stime) / docs,
+        "peak_rss_mb": usage.ru_maxrss / 1024,  # of the largest single process
+        "bulk_requests": received["requests"],
+        "rejections": received["rejections"],
+        "wire_mb": received["wire_bytes"] / 1024 / 1024,
+        "body_mb": received["body_bytes"] / 1024 / 1024,
+    }
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+@click.command()
+@click.option('--indexer', type=click.Choice(["products", "queries"]), default="products", show_default=True, help="The indexer to benchmark")
+@click.option('--source', '-s', default=None, help="Products XML directory (or queries CSV file) to index; generated when not given")
+@click.option('--generate', '-g', default=20000, show_default=True, help="Without --source, the number of products (or query rows) to generate")
+@click.option('--files', default=4, show_default=True, help="The number of XML files to spread the generated products over")
+@click.option('--seed', default=0, show_default=True, help="Seed of the generated data")
+@click.option('--latency', default=0.0, show_default=True, help="Seconds the fake cluster takes per _bulk request")
+@click.option('--reject_rate', default=0.0, show_default=True, help="Share of the bulk items the fake cluster rejects with a 429")
+@click.option('--runs', '-r', default=3, show_default=True, help="Runs to take the median of")
+@click.option('--indexer_args', default="", help="Extra options for the indexer, e.g. \"-w 4 --raw_bulk\"")
+@click.option('--output', '-o', default=None, help="Write the median results to this JSON file")
+@click.option('--compare', '-c', default=None, help="A results JSON file of an earlier benchmark to compare against")
+def main(indexer: str, source: str, generate: int, files: int, seed: int, latency: float, reject_rate: float, runs: int,
+         indexer_args: str, output: str, compare: str):
+    server = start_server(latency=latency, reject_rate=reject_rate)
+    with tempfile.TemporaryDirectory() as tmp:
+        if source is None:
+            rng = random.Random(seed)
+            if indexer == "products":
+                source = tmp
+                for i in range(files):
+                    generate_products(os.path.join(tmp, f"products_{i:04d}.xml"), generate // files, rng)
+            else:
+                source = os.path.join(tmp, "train.csv")
+                generate_queries(source, generate, rng)
+            logger.info(f"Generated {generate} {indexer} in {source}")
+        results = []
+        for run in range(runs):
+            result = run_indexer(indexer, os.path.abspath(source), server, shlex.split(indexer_args))
+            logger.info(f"Run {run + 1}: {result['docs']} docs in {result['seconds']:.2f}s, {result['docs_per_sec']:.0f} docs/sec")
+            results.append(result)
+    server.shutdown()
+    median = {key: _median([result[key] for result in results]) for key in results[0]}
+    median.update(indexer=indexer, indexer_args=indexer_args, latency=latency, reject_rate=reject_rate, runs=runs)
+    logger.info(f"{median['docs_per_sec']:.0f} docs/sec, {median['cpu_ms_per_doc']:.3f} ms CPU per doc, "
+                f"peak RSS {median['peak_rss_mb']:.0f} MiB, {median['bulk_requests']} bulk requests, "
+                f"{median['wire_mb']:.1f} MiB sent ({median['body_mb']:.1f} MiB uncompressed)")
+    if compare:
+        with open(compare) as f:
+            before = json.load(f)
+        for key in ("docs_per_sec", "cpu_ms_per_doc", "peak_rss_mb", "wire_mb"):
+            change = 100 * (median[key] - before[key]) / before[key] if before.get(key) else 0.0
+            logger.info(f"{key:>15}: {before[key]:.3f} -> {median[key]:.3f} ({change:+.1f}%)")
+    if output:
+        with open(output, "w") as f:
+            json.dump(median, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Recall@10 vs memory of the reduced precision embeddings of vector_quantization.py: the product names and the most
+# frequent queries are embedded once, the exact float32 top 10 of every query is the baseline, and each quantization
+# is scored by how much of it its own exact top 10 keeps. This measures the loss from quantizing the vectors only; the
+# HNSW graph loses some recall on top of it whatever the precision.
+# Usage: python bench_quantization.py -s /workspace/datasets/product_data/products -q /workspace/datasets/train.csv
+import click
+import glob
+import json
+import logging
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from sentence_transformers import SentenceTransformer
+
+from embedding_batches import EmbeddingBatches
+from embedding_cache import get_embedding_cache
+from product_xml import iter_products
+from vector_quantization import INT8_CLIP, QUANTIZATIONS, quantize
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+HNSW_M = 16  # the k-NN plugin's default number of graph links per vector
+
+
+def load_names(source_dir, max_names):
+    """The distinct product names of the XML files, at most max_names of them."""
+    names = {}
+    for file in sorted(glob.glob(source_dir + "/*.xml")):
+        for product in iter_products(file):
+            name = product.findtext("name")
+            if name:
+                names[name] = None
+                if len(names) >= max_names:
+                    return list(names)
+    return list(names)
+
+
+def top_k(docs, queries, k):
+    """The indices of the k docs most cosine similar to each query."""
+    docs = docs / np.linalg.norm(docs, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ docs.T
+    return np.argpartition(-scores, k, axis=1)[:, :k]
+
+
+def hnsw_bytes(vectors, dimension, bytes_per_value, m=HNSW_M):
+    """The k-NN plugin's sizing estimate of an HNSW graph: 1.1 * (bytes per vector + 8 * M) per vector."""
+    return 1.1 * (dimension * bytes_per_value + 8 * m) * vectors
+
+
+@click.command()
+@click.option('--source_dir', '-s', required=True, help="Products XML directory")
+@click.option('--queries_file', '-q', required=True, help="The train.csv query log")
+@click.option('--max_names', default=50000, show_default=True, help="Distinct product names to search")
+@click.option('--queries', default=1000, show_default=True, help="The number of most frequent queries to evaluate")
+@click.option('--clip', default=INT8_CLIP, show_default=True, help="The int8 clipping range (the clip of the mapping's _meta)")
+@click.option('--embedding_cache', default=None, help="Directory of an embedding cache to take the vectors from (and add them to)")
+@click.option('--output', '-o', default=None, help="Write the report to this JSON file")
+def main(source_dir: str, queries_file: str, max_names: int, queries: int, clip: float, embedding_cache: str, output: str):
+    names = load_names(source_dir, max_names)
+    user_queries = pd.read_csv(queries_file, usecols=["query"])["query"].dropna().value_counts().index[:queries].tolist()
+    cache = get_embedding_cache(embedding_cache, MODEL_NAME) if embedding_cache else None
+    embedder = EmbeddingBatches(SentenceTransformer(MODEL_NAME), cache=cache)
+    start = perf_counter()
+    doc_vectors = embedder.encode(names)
+    query_vectors = embedder.encode(user_queries)
+    logger.info(f"Embedded {len(names)} names and {len(user_queries)} queries in {perf_counter() - start:.1f}s")
+
+    k = 10
+    baseline = top_k(doc_vectors, query_vectors, k)
+    dimension = doc_vectors.shape[1]
+    report = {"names": len(names), "queries": len(user_queries), "k": k, "clip": clip, "results": {}}
+    for quantization in QUANTIZATIONS:
+        docs = quantize(doc_vectors, quantization, clip).astype(np.float32)
+        found = top_k(docs, quantize(query_vectors, quantization, clip).astype(np.float32), k)
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(baseline, found)])
+        bytes_per_value = {"float32": 4, "float16": 2, "int8": 1}[quantization]
+        report["results"][quantization] = {
+            f"recall_at_{k}": float(recall),
+            "vector_bytes": dimension * bytes_per_value,
+            "hnsw_mib": hnsw_bytes(len(names), dimension, bytes_per_value) / 1024 / 1024,
+            "hnsw_mib_per_million": hnsw_bytes(1_000_000, dimension, bytes_per_value) / 1024 / 1024,
+        }
+    float32_mib = report["results"]["float32"]["hnsw_mib"]
+    for quantization, result in report["results"].items():
+        logger.info(f"{quantization:>8}: recall@{k} {result[f'recall_at_{k}']:.3f}, {result['vector_bytes']} bytes per "
+                    f"vector, HNSW ~{result['hnsw_mib']:.1f} MiB ({100 * result['hnsw_mib'] / float32_mib:.0f}% of "
+                    f"float32), {result['hnsw_mib_per_million']:.0f} MiB per million products")
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+# Adaptive bulk batching shared by the indexers (utilities/index_products.py, utilities/index_queries.py and
+# week4/utilities/index_products.py)
+import logging
+import os
+import random
+import time
+from collections import Counter
+from time import perf_counter
+
+from opensearchpy.exceptions import TransportError
+from opensearchpy.helpers import BulkIndexError
+
+from bulk_ndjson import encode_action, encode_action_json, send_bulk_body
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+RETRY_STATUS = (429, 502, 503, 504)  # rejected or temporarily unavailable: worth sending again
+SHRINK_REJECTED_FRACTION = 0.1  # the share of a request's documents that must be rejected for the batch to shrink
+
+
+class AdaptiveBatcher:
+    """Collects bulk actions and flushes them on a document count or a byte budget, whichever comes first.
+
+    The document count adapts to the cluster: it shrinks when a bulk request takes longer than target_latency, is
+    halved when more than shrink_rejected_fraction of its items are rejected (an occasional 429 only gets the rejected
+    items retried), and grows back while requests are fast. Only the items rejected with a status in
+    retry_status (or all of them, when the connection fails) are retried, with exponential backoff and jitter. Any other
+    item failure raises a BulkIndexError, like helpers.bulk does, unless its status is in ignore_status (e.g. 404 for
+    deletes of documents that are already gone). With a dead_letter path, the items that failed for good (including
+    those still rejected after max_retries) are appended to that NDJSON file as _bulk actions, ready to be replayed,
+    and indexing carries on.
+
+    Callers that need to know how far the index has got can pass a checkpoint value with each action and an on_flush
+    callback: after every successful flush it is called with the checkpoint of the last action in the flushed batch.
+
+    Each action is serialized once, to its NDJSON lines, as it is added (which also gives its exact size), and the
+    joined lines are the body of the bulk request. By default they are encoded with the client's serializer and sent
+    with client.bulk, compressed as the client is configured to. With raw_ndjson they are encoded with orjson and sent
+    with transport.perform_request, gzipped at gzip_level; the client must then be created with http_compress=False,
+    or the body gets compressed twice.
+
+    Usage:
+        with AdaptiveBatcher(client) as batcher:
+            for action in actions:
+                batcher.add(action)
+    """
+
+    def __init__(self, client, max_bytes=DEFAULT_MAX_BYTES, initial_docs=200, min_docs=10, max_docs=5000,
+                 target_latency=2.0, max_retries=5, initial_backoff=1.0, max_backoff=60.0, request_timeout=60,
+                 ignore_status=(), on_flush=None, raw_ndjson=False, gzip_level=1, retry_status=RETRY_STATUS,
+                 dead_letter=None, shrink_rejected_fraction=SHRINK_REJECTED_FRACTION):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.batch_docs = initial_docs
+        self.min_docs = min_docs
+        self.max_docs = max_docs
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self.ignore_status = ignore_status
+        self.retry_status = retry_status
+        self.dead_letter = dead_letter
+        self.shrink_rejected_fraction = shrink_rejected_fraction
+        self.on_flush = on_flush
+        self.raw_ndjson = raw_ndjson
+        self.gzip_level = gzip_level
+        self.serializer = client.transport.serializer
+        self.pending = []
+        self.pending_bodies = []
+        self.pending_bytes = 0
+        self.pending_checkpoint = None
+        # running totals, for the callers' summary logs
+        self.docs = 0
+        self.bytes = 0
+        self.requests = 0
+        self.rejections = 0
+        self.retries = 0
+        self.failed = 0
+        self.failed_ids = []  # the _ids of the dead lettered documents
+        self.serialize_seconds = 0.0
+        self.bulk_seconds = 0.0  # request round trips, without the backoff sleeps
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def encode(self, action):
+        """The NDJSON lines of action, as they go into the bulk body."""
+        if self.raw_ndjson:
+            return encode_action(action, default=self.serializer.default)
+        return encode_action_json(action, self.serializer)
+
+    def add(self, action, checkpoint=None):
+        self.pending.append(action)
+        start = perf_counter()
+        body = self.encode(action)
+        self.pending_bodies.append(body)
+        self.pending_bytes += len(body)
+        self.serialize_seconds += perf_counter() - start
+        if checkpoint is not None:
+            self.pending_checkpoint = checkpoint
+        if len(self.pending) >= self.batch_docs or self.pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        actions, bodies, size, checkpoint = self.pending, self.pending_bodies, self.pending_bytes, self.pending_checkpoint
+        self.pending = []
+        self.pending_bodies = []
+        self.pending_bytes = 0
+        self.pending_checkpoint = None
+        attempt = 0
+        while True:
+            start = perf_counter()
+            retry, failed = self._send(actions, bodies)
+            latency = perf_counter() - start
+            self.bulk_seconds += latency
+            self.requests += 1
+            self.bytes += size
+            self.docs += len(actions) - len(retry) - len(failed)
+            if failed:
+                self._fail(actions, bodies, failed)
+            if not retry:
+                self._adapt(latency)
+                if self.on_flush is not None and checkpoint is not None:
+                    self.on_flush(checkpoint)
+                return
+            self.rejections += len(retry)
+            # judged on the whole batch: a retry of a few documents being rejected again says little about the size
+            if attempt == 0 and len(retry) > self.shrink_rejected_fraction * len(actions):
+                self.batch_docs = max(self.min_docs, self.batch_docs // 2)
+            attempt += 1
+            if attempt > self.max_retries:
+                self._fail(actions, bodies, [(i, {'index': {'status': 429, '_id': actions[i].get('_id'),
+                                                            'error': f'still rejected after {self.max_retries} retries'}})
+                                             for i in retry])
+                if self.on_flush is not None and checkpoint is not None:
+                    self.on_flush(checkpoint)
+                return
+            backoff = min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+            logger.debug(f"{len(retry)} of {len(actions)} documents rejected, retrying in {backoff:.1f}s "
+                         f"with batch size now {self.batch_docs}")
+            time.sleep(backoff * random.uniform(0.5, 1.0))
+            self.retries += len(retry)
+            actions = [actions[i] for i in retry]
+            bodies = [bodies[i] for i in retry]
+            size = sum(len(body) for body in bodies)
+
+    def _send(self, actions, bodies):
+        """Sends actions as one bulk request. Returns the positions of the items to retry (rejected with a retryable
+        status, or all of them when the request itself failed that way) and the (position, item) of the items that
+        failed for good."""
+        items = self._send_bodies(bodies)
+        retry = []
+        failed = []
+        for i, item in enumerate(items):
+            status = next(iter(item.values())).get('status')
+            if isinstance(status, int) and 200 <= status < 300:
+                continue
+            # a connection error is reported as the status 'N/A' of every item
+            if status in self.retry_status or not isinstance(status, int):
+                retry.append(i)
+            elif status not in self.ignore_status:
+                failed.append((i, item))
+        return retry, failed
+
+    def _send_bodies(self, bodies):
+        try:
+            if self.raw_ndjson:
+                response = send_bulk_body(self.client, b"".join(bodies), self.gzip_level, self.request_timeout)
+            else:
+                response = self.client.bulk(body=b"".join(bodies), request_timeout=self.request_timeout)
+        except TransportError as e:
+            if e.status_code in self.retry_status or not isinstance(e.status_code, int):
+                return [{'index': {'status': e.status_code}}] * len(bodies)
+            raise
+        if not response.get('errors'):
+            return []
+        return response['items']
+
+    def _fail(self, actions, bodies, failed):
+        """Writes the failed items to the dead letter file, or raises a BulkIndexError without one."""
+        errors = [item for _, item in failed]
+        if self.dead_letter is None:
+            raise BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+        self.failed += len(failed)
+        self.failed_ids.extend(actions[i].get('_id') for i, _ in failed)
+        for _, item in failed[:3]:
+            logger.warning(f"Dead lettering a failed document: {item}")
+        lines = b"".join(bodies[i] for i, _ in failed)
+        # One append per batch: O_APPEND writes of the workers sharing the file land whole
+        fd = os.open(self.dead_letter, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines)
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        """The running totals, which log_bulk_summary adds up across batchers."""
+        return Counter(docs=self.docs, bytes=self.bytes, requests=self.requests, rejections=self.rejections,
+                       retries=self.retries, failed=self.failed, serialize_seconds=self.serialize_seconds,
+                       bulk_seconds=self.bulk_seconds)
+
+    def _adapt(self, latency):
+        if latency > self.target_latency:
+            self.batch_docs = max(self.min_docs, int(self.batch_docs * 0.75))
+        elif latency < self.target_latency / 2:
+            self.batch_docs = min(self.max_docs, int(self.batch_docs * 1.25) + 1)
+
+
+def log_bulk_summary(stats, elapsed):
+    """Logs the totals of the stats() of all the batchers of a run, elapsed seconds being its wall clock time."""
+    sent = stats['docs'] + stats['failed']
+    logger.info(f"Bulk: {stats['docs']} docs indexed in {stats['requests']} requests ({stats['bytes'] / 1024 / 1024:.1f} MiB), "
+                f"{stats['docs'] / elapsed if elapsed > 0 else 0.0:.0f} docs/sec")
+    logger.info(f"Retries: {stats['rejections']} rejections, {stats['retries']} documents re-sent "
+                f"({100 * stats['retries'] / sent if sent else 0.0:.2f}% of the documents), {stats['failed']} dead lettered")
@@ -0,0 +1,105 @@
+# Offline bulk files: ready to send, gzipped _bulk bodies written to a directory instead of a cluster, to be loaded
+# later (into as many clusters as needed) with replay_bulk_files.py
+import glob
+import gzip
+import logging
+import os
+import uuid
+from collections import Counter
+from time import perf_counter
+
+from opensearchpy.serializer import JSONSerializer
+
+from bulk_batcher import DEFAULT_MAX_BYTES, AdaptiveBatcher
+from bulk_ndjson import encode_action
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+CHUNK_SUFFIX = ".ndjson.gz"
+
+
+def list_chunk_files(chunk_dir):
+    return sorted(glob.glob(os.path.join(chunk_dir, "*" + CHUNK_SUFFIX)))
+
+
+class BulkFileWriter:
+    """Stands in for an AdaptiveBatcher when exporting: every flush writes one gzipped _bulk body, holding up to
+    max_docs actions or max_bytes of NDJSON, to <output_dir>/<name>-<run id>-<sequence>.ndjson.gz.
+
+    The run id keeps a resumed export from overwriting the chunks an earlier run already wrote, and chunks are written
+    to a temporary file and renamed, so an interrupted run never leaves a partial chunk behind. on_flush and the
+    counters and stats() work as in AdaptiveBatcher (requests counts the chunks written).
+    """
+
+    def __init__(self, output_dir, name=None, max_bytes=DEFAULT_MAX_BYTES, max_docs=5000, gzip_level=1, on_flush=None):
+        self.output_dir = output_dir
+        self.prefix = f"{name}-{uuid.uuid4().hex[:8]}" if name else uuid.uuid4().hex
+        self.max_bytes = max_bytes
+        self.batch_docs = max_docs
+        self.gzip_level = gzip_level
+        self.on_flush = on_flush
+        self.default = JSONSerializer().default
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_checkpoint = None
+        self.docs = 0
+        self.bytes = 0
+        self.requests = 0
+        self.rejections = 0  # nothing is rejected offline, kept for the callers' summary logs
+        self.serialize_seconds = 0.0
+        self.bulk_seconds = 0.0  # compressing and writing the chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, action, checkpoint=None):
+        start = perf_counter()
+        body = encode_action(action, default=self.default)
+        self.serialize_seconds += perf_counter() - start
+        self.pending.append(body)
+        self.pending_bytes += len(body)
+        if checkpoint is not None:
+            self.pending_checkpoint = checkpoint
+        if len(self.pending) >= self.batch_docs or self.pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        start = perf_counter()
+        path = os.path.join(self.output_dir, f"{self.prefix}-{self.requests:05d}{CHUNK_SUFFIX}")
+        with open(path + ".tmp", "wb") as f:
+            f.write(gzip.compress(b"".join(self.pending), compresslevel=self.gzip_level))
+        os.replace(path + ".tmp", path)
+        self.bulk_seconds += perf_counter() - start
+        self.requests += 1
+        self.docs += len(self.pending)
+        self.bytes += self.pending_bytes
+        checkpoint = self.pending_checkpoint
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_checkpoint = None
+        if self.on_flush is not None and checkpoint is not None:
+            self.on_flush(checkpoint)
+
+    def stats(self):
+        return Counter(docs=self.docs, bytes=self.bytes, requests=self.requests,
+                       serialize_seconds=self.serialize_seconds, bulk_seconds=self.bulk_seconds)
+
+
+def open_batcher(client, bulk_options=None, name=None, **kwargs):
+    """Returns the batcher bulk_options (plus kwargs) ask for: with a to_ndjson directory a BulkFileWriter whose chunk
+    files are named after name, otherwise an AdaptiveBatcher sending to client."""
+    options = dict(bulk_options or {}, **kwargs)
+    output_dir = options.pop('to_ndjson', None)
+    if output_dir is None:
+        return AdaptiveBatcher(client, **options)
+    return BulkFileWriter(output_dir, name, max_bytes=options.get('max_bytes', DEFAULT_MAX_BYTES),
+                          max_docs=options.get('max_docs', 5000), gzip_level=options.get('gzip_level', 1),
+                          on_flush=options.get('on_flush'))
@@ -0,0 +1,43 @@
+# Index settings for a full (re)load: no refreshes and no replicas while loading, restored afterwards
+import logging
+from contextlib import contextmanager
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+BULK_LOAD_SETTINGS = {"index.refresh_interval": "-1", "index.number_of_replicas": "0"}
+
+
+def get_load_settings(client, index_name):
+    """Returns {index: {setting: value}} for the settings BULK_LOAD_SETTINGS changes. A setting the index doesn't set
+    explicitly comes back as None, which resets it to the cluster default when put back."""
+    response = client.indices.get_settings(index=index_name, flat_settings=True)
+    return {index: {name: body["settings"].get(name) for name in BULK_LOAD_SETTINGS}
+            for index, body in response.items()}
+
+
+@contextmanager
+def bulk_load(client, index_name, force_merge_segments=None, request_timeout=3600):
+    """Turns off refreshes and replicas on index_name for the duration of the block.
+
+    The original settings are put back when the block exits, whether or not it raised. If it completed and
+    force_merge_segments is set, the index is then refreshed and force merged down to that many segments.
+    """
+    original = get_load_settings(client, index_name)
+    logger.info(f"Bulk load mode for {index_name}: setting {BULK_LOAD_SETTINGS}, original settings {original}")
+    client.indices.put_settings(index=index_name, body=BULK_LOAD_SETTINGS)
+    try:
+        yield
+    finally:
+        for index, settings in original.items():
+            logger.info(f"Restoring {settings} on {index}")
+            client.indices.put_settings(index=index, body=settings)
+    client.indices.refresh(index=index_name, request_timeout=request_timeout)
+    if force_merge_segments:
+        logger.info(f"Force merging {index_name} to {force_merge_segments} segment(s)")
+        start = perf_counter()
+        client.indices.forcemerge(index=index_name, max_num_segments=force_merge_segments,
+                                  request_timeout=request_timeout)
+        logger.info(f"Force merge done in {(perf_counter() - start)/60:.1f} minutes")
@@ -0,0 +1,77 @@
+# Builds _bulk request bodies directly as NDJSON bytes with orjson and sends them through the client's transport,
+# skipping the stdlib json encoding (and the level 9 gzip) of the client
+import gzip
+
+import orjson
+
+# The action keys that go on the action line rather than in the document, as in opensearchpy.helpers.expand_action
+META_FIELDS = ("_index", "_id", "_routing", "routing", "pipeline", "_version", "version", "_version_type",
+               "version_type", "if_seq_no", "if_primary_term", "retry_on_conflict", "require_alias")
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY  # embeddings are numpy arrays
+
+
+def _split_action(action):
+    """(op_type, action line metadata, source) of a bulk action, source being None for deletes."""
+    op_type = action.get('_op_type', 'index')
+    meta = {key: action[key] for key in META_FIELDS if key in action}
+    if op_type == 'delete':
+        return op_type, meta, None
+    if '_source' in action:
+        source = action['_source']
+    else:
+        source = {key: value for key, value in action.items() if key not in META_FIELDS and key != '_op_type'}
+    return op_type, meta, source
+
+
+def encode_action(action, default=None):
+    """Encodes one bulk action (in the format helpers.bulk accepts) as its NDJSON lines.
+
+    default is called for the types orjson doesn't know, e.g. the client serializer's default for pandas values.
+    """
+    op_type, meta, source = _split_action(action)
+    line = orjson.dumps({op_type: meta})
+    if source is None:
+        return line + b"\n"
+    return line + b"\n" + orjson.dumps(source, default=default, option=ORJSON_OPTIONS) + b"\n"
+
+
+def encode_action_json(action, serializer):
+    """encode_action with the client's own serializer (the stdlib json encoder), for bodies sent with client.bulk."""
+    op_type, meta, source = _split_action(action)
+    lines = serializer.dumps({op_type: meta}) + "\n"
+    if source is not None:
+        lines += serializer.dumps(source) + "\n"
+    return lines.encode("utf-8")
+
+
+def split_actions(body):
+    """Splits an NDJSON _bulk body into the encoded bytes of each action, in order (the inverse of joining
+    encode_action results). Only the action lines are decoded."""
+    lines = body.splitlines(keepends=True)
+    actions = []
+    i = 0
+    while i < len(lines):
+        if not lines[i].strip():
+            i += 1
+            continue
+        op_type = next(iter(orjson.loads(lines[i])))
+        size = 1 if op_type == 'delete' else 2
+        actions.append(b"".join(lines[i:i + size]))
+        i += size
+    return actions
+
+
+def send_bulk_body(client, body, gzip_level=1, request_timeout=60, precompressed=False):
+    """POSTs an NDJSON body to _bulk and returns the parsed response.
+
+    The body is gzipped here at gzip_level (0 sends it uncompressed), or sent as is when it is precompressed (already
+    gzipped), so the client must not have http_compress on.
+    """
+    headers = {"Content-Type": "application/x-ndjson"}
+    if precompressed:
+        headers["Content-Encoding"] = "gzip"
+    elif gzip_level:
+        body = gzip.compress(body, compresslevel=gzip_level)
+        headers["Content-Encoding"] = "gzip"
+    return client.transport.perform_request("POST", "/_bulk", headers=headers, body=body,
+                                            params={"request_timeout": request_timeout})
@@ -0,0 +1,132 @@
+# Pipelined indexing: parser processes feed a bounded queue of bulk batches that a pool of sender threads drains
+import concurrent.futures
+import logging
+import multiprocessing
+from collections import Counter
+from time import perf_counter
+
+from bulk_files import open_batcher
+from stage_metrics import StageTimer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+_DONE = None  # queue sentinel, one per sender
+
+
+def _parse_into_queue(produce, file, queue, batch_size):
+    """Runs in a parser process: builds the actions for one file and puts them on the queue in batches.
+
+    queue.put blocks while the queue is full, which is what pushes back on the parsers when the cluster is slow.
+    Returns (docs, busy seconds, seconds blocked on the queue, the stage times produce added to its timer).
+    """
+    start = perf_counter()
+    timer = StageTimer()
+    blocked = 0.0
+    docs = 0
+    batch = []
+    for action in produce(file, timer=timer):
+        batch.append(action)
+        docs += 1
+        if len(batch) >= batch_size:
+            put_start = perf_counter()
+            queue.put(batch)
+            blocked += perf_counter() - put_start
+            batch = []
+    if batch:
+        put_start = perf_counter()
+        queue.put(batch)
+        blocked += perf_counter() - put_start
+    return docs, perf_counter() - start - blocked, blocked, timer.totals
+
+
+class _Sender:
+    """Drains batches from the queue into an AdaptiveBatcher on its own client (or a BulkFileWriter), tracking busy
+    and idle time."""
+
+    def __init__(self, client, queue, bulk_options=None):
+        self.client = client
+        self.queue = queue
+        self.bulk_options = bulk_options or {}
+        self.idle = 0.0
+        self.finished = False
+
+    def _actions(self):
+        while True:
+            get_start = perf_counter()
+            batch = self.queue.get()
+            self.idle += perf_counter() - get_start
+            if batch is _DONE:
+                self.finished = True
+                return
+            yield from batch
+
+    def run(self):
+        start = perf_counter()
+        # The batcher backs off on 429s and slow requests, which slows the drain and lets the queue fill up
+        batcher = open_batcher(self.client, self.bulk_options)
+        try:
+            for action in self._actions():
+                batcher.add(action)
+            batcher.flush()
+        except Exception:
+            # Keep draining so the parsers are not left blocked on a full queue, then report the failure
+            if not self.finished:
+                for _ in self._actions():
+                    pass
+            raise
+        return batcher.stats(), perf_counter() - start - self.idle, self.idle
+
+
+def _rate(docs, seconds):
+    return docs / seconds if seconds > 0 else 0.0
+
+
+def run_pipeline(files, produce, client_factory, parsers=8, senders=4, queue_size=32, batch_size=200,
+                 bulk_options=None):
+    """Indexes files through the parse -> bulk pipeline and returns the senders' batcher stats() added up, plus the
+    parsers' stage times.
+
+    produce(file, timer=StageTimer) must be a picklable callable yielding bulk actions; client_factory() returns a new OpenSearch client
+    and is called once per sender. batch_size is the number of actions per queue entry, the bulk requests themselves are
+    sized by each sender's AdaptiveBatcher, which is created with the bulk_options keyword arguments.
+    """
+    start = perf_counter()
+    with multiprocessing.Manager() as manager:
+        queue = manager.Queue(maxsize=queue_size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=senders) as send_pool:
+            send_futures = [send_pool.submit(_Sender(client_factory(), queue, bulk_options).run)
+                            for _ in range(senders)]
+            parsed = parse_busy = parse_blocked = 0
+            parse_stats = Counter()
+            try:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=parsers) as parse_pool:
+                    parse_futures = [parse_pool.submit(_parse_into_queue, produce, file, queue, batch_size)
+                                     for file in files]
+                    for future in concurrent.futures.as_completed(parse_futures):
+                        docs, busy, blocked, stage_totals = future.result()
+                        parse_stats.update(stage_totals)
+                        parsed += docs
+                        parse_busy += busy
+                        parse_blocked += blocked
+            finally:
+                for _ in range(senders):
+                    queue.put(_DONE)
+            stats = Counter()
+            send_busy = send_idle = 0
+            for future in send_futures:
+                sender_stats, busy, idle = future.result()
+                stats += sender_stats
+                send_busy += busy
+                send_idle += idle
+    sent = stats['docs']
+    stats.update(parse_stats)
+    elapsed = perf_counter() - start
+    # Busy times are summed over workers, so the per stage rates are per worker; the end to end rate is wall clock
+    logger.info(f"Parse stage: {parsed} docs, {_rate(parsed, parse_busy):.0f} docs/sec per parser, "
+                f"{parse_blocked:.1f}s blocked on a full queue across {parsers} parsers")
+    logger.info(f"Bulk stage: {sent} docs, {_rate(sent, send_busy):.0f} docs/sec per sender, "
+                f"{send_idle:.1f}s idle on an empty queue across {senders} senders")
+    logger.info(f"Pipeline: {_rate(sent, elapsed):.0f} docs/sec end to end")
+    return stats
@@ -0,0 +1,61 @@
+# Checkpoint journal for resumable indexing runs
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+
+class CheckpointJournal:
+    """SQLite journal of indexing progress per (index, file).
+
+    offset is the position in the file of the first product that has not been flushed to the index yet, so a resumed
+    run restarts the file from there; done marks files that were completely indexed. Every indexing worker opens its
+    own journal on the same path and only writes the rows of the file it is working on.
+    """
+
+    def __init__(self, path, index_name):
+        self.index_name = index_name
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS checkpoints (index_name TEXT NOT NULL, file TEXT NOT NULL, "
+                          "offset INTEGER NOT NULL, done INTEGER NOT NULL, PRIMARY KEY (index_name, file))")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def reset(self):
+        """Forgets the progress of earlier runs against this index."""
+        with self.conn:
+            self.conn.execute("DELETE FROM checkpoints WHERE index_name = ?", (self.index_name,))
+
+    def get(self, file):
+        """Returns (offset, done) for file, (0, False) if it hasn't been started."""
+        row = self.conn.execute("SELECT offset, done FROM checkpoints WHERE index_name = ? AND file = ?",
+                                (self.index_name, file)).fetchone()
+        return (0, False) if row is None else (row[0], bool(row[1]))
+
+    def save(self, file, offset, done=False):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO checkpoints (index_name, file, offset, done) VALUES (?, ?, ?, ?)",
+                              (self.index_name, file, offset, int(done)))
+
+
+def resume_points(checkpoint_path, index_name, files, resume):
+    """Returns {file: product offset to start at} for the files still to index. Without resume the journal is reset."""
+    journal = CheckpointJournal(checkpoint_path, index_name)
+    try:
+        if not resume:
+            journal.reset()
+            return dict.fromkeys(files, 0)
+        starts = {}
+        for file in files:
+            offset, done = journal.get(file)
+            if not done:
+                starts[file] = offset
+        logger.info(f'Resuming: {len(files) - len(starts)} files already done, {sum(1 for o in starts.values() if o > 0)} partially done')
+        return starts
+    finally:
+        journal.close()
@@ -0,0 +1,68 @@
+# Local SKU -> content hash manifest, so a refresh of the product index only sends what changed between dumps
+import hashlib
+import json
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+
+def content_hash(doc):
+    """A stable hash of an extracted document."""
+    return hashlib.blake2b(json.dumps(doc, sort_keys=True, default=str).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def sku_hash(doc_hashes):
+    """The hash recorded for a SKU, from the content hashes of its documents in file order: a SKU that appears more
+    than once in a file (the last document wins in the index) is only unchanged if all of its documents are."""
+    if len(doc_hashes) == 1:
+        return doc_hashes[0]
+    return hashlib.blake2b("".join(doc_hashes).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class DeltaManifest:
+    """SQLite table of (index, sku) -> hash of the document last sent for it.
+
+    The indexing workers only read it (lookup); the main process records what each finished file contained (record)
+    and, once every file is done, works out which SKUs disappeared from the dump (stale_skus). The database runs in
+    WAL mode so the workers can keep reading while the main process writes.
+
+    The manifest describes the contents of the index, so delete the file whenever the index itself is recreated.
+    """
+
+    def __init__(self, path, index_name):
+        self.index_name = index_name
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS manifest (index_name TEXT NOT NULL, sku TEXT NOT NULL, "
+                          "hash TEXT NOT NULL, PRIMARY KEY (index_name, sku))")
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (sku TEXT PRIMARY KEY)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, sku):
+        row = self.conn.execute("SELECT hash FROM manifest WHERE index_name = ? AND sku = ?",
+                                (self.index_name, sku)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, seen):
+        """Stores the (sku, hash) pairs of a file whose documents have all been sent."""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO manifest (index_name, sku, hash) VALUES (?, ?, ?)",
+                                  ((self.index_name, sku, doc_hash) for sku, doc_hash in seen))
+            self.conn.executemany("INSERT OR IGNORE INTO seen (sku) VALUES (?)", ((sku,) for sku, _ in seen))
+
+    def stale_skus(self):
+        """The SKUs in the manifest that were not recorded during this run."""
+        rows = self.conn.execute("SELECT sku FROM manifest WHERE index_name = ? AND sku NOT IN (SELECT sku FROM seen)",
+                                 (self.index_name,))
+        return [row[0] for row in rows]
+
+    def remove(self, skus):
+        with self.conn:
+            self.conn.executemany("DELETE FROM manifest WHERE index_name = ? AND sku = ?",
+                                  ((self.index_name, sku) for sku in skus))
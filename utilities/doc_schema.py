@@ -0,0 +1,78 @@
+# Schema driven compaction of the extracted product documents, using the field types of the index mappings
+import json
+import logging
+import os
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+PRODUCTS_MAPPINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "conf", "bbuy_products.json")
+
+
+def _to_bool(value):
+    lowered = value.strip().lower()
+    if lowered in ("true", "false"):
+        return lowered == "true"
+    raise ValueError(f"not a boolean: {value!r}")
+
+
+# Mapping types whose values are scalars: the extracted strings are converted with these, and a single value is sent
+# as the value itself instead of a one element list
+SCALAR_TYPES = {
+    "boolean": _to_bool,
+    "long": int,
+    "integer": int,
+    "short": int,
+    "byte": int,
+    "float": float,
+    "half_float": float,
+    "double": float,
+    "scaled_float": float,
+    "date": str,
+    "keyword": str,
+}
+
+
+class DocSchema:
+    """Compacts documents before they are serialized: empty fields are dropped, and fields mapped to a scalar type are
+    coerced to that type and unwrapped when they hold a single value. Text fields (name, sku, categoryPath, ...) stay
+    lists, so readers of e.g. hit['_source']['name'][0] keep working. A value that doesn't convert is sent unchanged,
+    which leaves it to the index exactly as before."""
+
+    def __init__(self, field_types):
+        self.field_types = field_types
+
+    @classmethod
+    def from_mappings_file(cls, path=PRODUCTS_MAPPINGS_FILE):
+        with open(path) as f:
+            properties = json.load(f)["mappings"]["properties"]
+        return cls({name: prop.get("type", "object") for name, prop in properties.items()})
+
+    def compact(self, doc):
+        compacted = {}
+        for key, value in doc.items():
+            if isinstance(value, list):
+                if len(value) == 0:
+                    continue
+                convert = SCALAR_TYPES.get(self.field_types.get(key))
+                if convert is not None:
+                    value = [self._convert(convert, v) for v in value]
+                    if len(value) == 1:
+                        value = value[0]
+            compacted[key] = value
+        return compacted
+
+    @staticmethod
+    def _convert(convert, value):
+        try:
+            return convert(value)
+        except (TypeError, ValueError):
+            return value
+
+
+@lru_cache(maxsize=None)
+def load_doc_schema(path=PRODUCTS_MAPPINGS_FILE):
+    """The DocSchema of a mappings file, loaded once per process."""
+    return DocSchema.from_mappings_file(path)
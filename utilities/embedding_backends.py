@@ -0,0 +1,113 @@
+# Sentence embedding backends with the interface of SentenceTransformer.encode (list of texts -> float32 ndarray): the
+# eager PyTorch model, or all-MiniLM-L6-v2 exported once to ONNX (optionally with dynamically quantized int8 weights)
+# and run by onnxruntime with explicit thread settings, which is faster on our CPU only boxes
+import logging
+import os
+from functools import lru_cache
+from time import perf_counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+BACKENDS = ("torch", "onnx", "onnx_int8")
+DEFAULT_ONNX_DIR = "/workspace/models/all-MiniLM-L6-v2-onnx"
+ONNX_FILES = {"onnx": "model.onnx", "onnx_int8": "model_int8.onnx"}
+MAX_SEQ_LENGTH = 256  # the max_seq_length of all-MiniLM-L6-v2
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+def export_onnx(model_name, onnx_dir):
+    """Exports the transformer of a sentence-transformers model and its tokenizer to onnx_dir, with dynamic batch and
+    sequence axes, and writes the int8 variant next to it. Needs torch and transformers, which running it doesn't."""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+    repo = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+    os.makedirs(onnx_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(repo)
+    model = AutoModel.from_pretrained(repo).eval()
+    sample = tokenizer(["an example product name"], return_tensors="pt")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES + ["last_hidden_state"]}
+    start = perf_counter()
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in INPUT_NAMES), os.path.join(onnx_dir, ONNX_FILES["onnx"]),
+                          input_names=INPUT_NAMES, output_names=["last_hidden_state"], dynamic_axes=dynamic_axes,
+                          opset_version=14)
+    quantize_dynamic(os.path.join(onnx_dir, ONNX_FILES["onnx"]), os.path.join(onnx_dir, ONNX_FILES["onnx_int8"]),
+                     weight_type=QuantType.QInt8)
+    tokenizer.save_pretrained(onnx_dir)
+    logger.info(f"Exported {repo} to {onnx_dir} in {perf_counter() - start:.1f}s")
+
+
+class OnnxEncoder:
+    """all-MiniLM-L6-v2 on onnxruntime: the exported transformer, then the mean pooling over the attention mask and
+    the normalization the sentence-transformers model adds on top of it.
+
+    threads is the intra-op thread count of the session (default: onnxruntime's choice, all the cores); inter-op
+    parallelism is off, since a BERT graph is one chain of operators.
+    """
+
+    def __init__(self, onnx_dir=DEFAULT_ONNX_DIR, quantized=False, threads=None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        path = os.path.join(onnx_dir, ONNX_FILES["onnx_int8" if quantized else "onnx"])
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(texts[i:i + batch_size], padding=True, truncation=True,
+                                    max_length=MAX_SEQ_LENGTH, return_tensors="np")
+            hidden = self.session.run(None, {name: inputs[name].astype(np.int64) for name in self.input_names})[0]
+            mask = inputs["attention_mask"][..., np.newaxis].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            vectors.append(pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None))
+        return np.concatenate(vectors).astype(np.float32) if vectors else np.empty((0, 0), dtype=np.float32)
+
+
+def ensure_onnx_export(backend, model_name, onnx_dir=DEFAULT_ONNX_DIR):
+    """Exports the model to onnx_dir if backend needs the export and it isn't there yet."""
+    if backend in ONNX_FILES and not os.path.exists(os.path.join(onnx_dir, ONNX_FILES[backend])):
+        export_onnx(model_name, onnx_dir)
+
+
+def load_encoder(backend, model_name, threads=None, onnx_dir=DEFAULT_ONNX_DIR):
+    """A model with encode(list of texts) for backend: the SentenceTransformer (threads caps torch's intra-op threads)
+    or an OnnxEncoder, exported to onnx_dir on first use."""
+    start = perf_counter()
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        encoder = SentenceTransformer(model_name)
+    elif backend in ONNX_FILES:
+        ensure_onnx_export(backend, model_name, onnx_dir)
+        encoder = OnnxEncoder(onnx_dir, quantized=backend == "onnx_int8", threads=threads)
+    else:
+        raise ValueError(f"Unknown embedding backend {backend}, expected one of {BACKENDS}")
+    logger.info(f"Loaded {model_name} on {backend} in {perf_counter() - start:.1f}s")
+    return encoder
+
+
+@lru_cache(maxsize=None)
+def get_encoder(backend, model_name, threads=None, onnx_dir=DEFAULT_ONNX_DIR):
+    """The encoder of the current process for these settings, loaded once."""
+    return load_encoder(backend, model_name, threads, onnx_dir)
+
+
+def cache_model_name(model_name, backend):
+    """The model name vectors are cached under: the float32 ONNX export computes the same vectors as PyTorch (to
+    rounding), but the int8 one doesn't, so its vectors are kept apart."""
+    return f"{model_name}-onnx-int8" if backend == "onnx_int8" else model_name
@@ -0,0 +1,74 @@
+# Embedding batches built for the model rather than for the bulk requests: the texts collected over many documents
+# are deduplicated, ordered by token length and encoded batch_size at a time, so each model batch pads its texts to
+# about the same length, and the vectors are scattered back to the positions of the texts they came from
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+DEFAULT_WINDOW = 2048  # documents collected before their names are encoded
+DEFAULT_BATCH_SIZE = 64  # texts per model batch
+
+
+def token_lengths(model, texts):
+    """The token counts of texts with the model's tokenizer, or their character lengths if it has none."""
+    tokenizer = getattr(model, "tokenizer", None)
+    if tokenizer is None:
+        return [len(text) for text in texts]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+
+def encode_by_length(texts, encode, batch_size=DEFAULT_BATCH_SIZE, lengths=None):
+    """Encodes texts batch_size at a time, shortest first, and returns the float32 vectors in the order of texts.
+    encode(list of texts) -> one vector per text, e.g. model.encode; lengths defaults to the character lengths."""
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    if lengths is None:
+        lengths = [len(text) for text in texts]
+    order = np.argsort(lengths, kind="stable")
+    vectors = None
+    for i in range(0, len(texts), batch_size):
+        batch = order[i:i + batch_size]
+        encoded = np.asarray(encode([texts[j] for j in batch]), dtype=np.float32)
+        if vectors is None:
+            vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+        vectors[batch] = encoded
+    return vectors
+
+
+class EmbeddingBatches:
+    """Encodes the texts of a window of documents: the distinct texts not in cache (an EmbeddingCache, optional) go
+    to the model in length ordered batches, and encode(texts) returns a vector for every text, duplicates included.
+
+    model.encode is called with batch_size set to the size of each batch, so it doesn't batch (and pad) again.
+    """
+
+    def __init__(self, model, batch_size=DEFAULT_BATCH_SIZE, cache=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.cache = cache
+        self.texts = 0
+        self.distinct = 0
+        self.encoded = 0
+
+    def _encode_distinct(self, texts):
+        lengths = token_lengths(self.model, texts)
+        self.encoded += len(texts)
+        return encode_by_length(texts, lambda batch: self.model.encode(batch, batch_size=len(batch)),
+                                self.batch_size, lengths)
+
+    def encode(self, texts):
+        distinct = list(dict.fromkeys(texts))
+        self.texts += len(texts)
+        self.distinct += len(distinct)
+        if self.cache is not None:
+            vectors = self.cache.encode(distinct, self._encode_distinct)
+        else:
+            vectors = self._encode_distinct(distinct)
+        if len(distinct) == len(texts):
+            return vectors
+        positions = {text: i for i, text in enumerate(distinct)}
+        return vectors[[positions[text] for text in texts]]
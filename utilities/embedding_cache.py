@@ -0,0 +1,131 @@
+# On-disk cache of text embeddings keyed by (model name, text hash), so reindexing only runs the model on names it
+# hasn't seen before and repeated vector queries skip the model entirely
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+from functools import lru_cache
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+LOOKUP_CHUNK = 500  # hashes per SELECT ... IN, under SQLite's parameter limit
+
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """The vectors of a model, stored as rows of a raw float32 or float16 matrix file (<model>.vectors, memory mapped
+    for reading), and a SQLite key index of (model, text hash) -> row next to it (keys.db).
+
+    Rows are only ever appended. A writer allocates its rows, writes the vectors and inserts their keys within one
+    write transaction, so several indexing workers can share the cache and a key is never visible before its vector.
+    With float16 the vectors a miss returns are rounded the same way as the stored ones, so results don't depend on
+    whether the cache was warm.
+    """
+
+    def __init__(self, cache_dir, model_name, dtype=None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.model_name = model_name
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "keys.db"), timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, dim INTEGER NOT NULL, "
+                          "dtype TEXT NOT NULL, rows INTEGER NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, hash BLOB NOT NULL, "
+                          "row INTEGER NOT NULL, PRIMARY KEY (model, hash))")
+        row = self.conn.execute("SELECT dim, dtype FROM models WHERE model = ?", (model_name,)).fetchone()
+        if row is not None and dtype is not None and row[1] != np.dtype(dtype).name:
+            logger.warning(f"The {model_name} vectors in {cache_dir} are stored as {row[1]}; keeping that rather than {dtype}")
+        self.dim = None if row is None else row[0]  # known once the first vectors are stored
+        # an existing cache keeps the dtype it was created with; a new one stores dtype (default float32)
+        self.dtype = np.dtype(row[1] if row is not None else dtype or "float32")
+        self.path = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name) + ".vectors")
+        self.vectors = None  # the memory map, reopened when rows beyond it are needed
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.conn.close()
+
+    def _rows(self, hashes):
+        """{hash: row} of the hashes that are cached."""
+        rows = {}
+        for i in range(0, len(hashes), LOOKUP_CHUNK):
+            chunk = hashes[i:i + LOOKUP_CHUNK]
+            rows.update(self.conn.execute(
+                f"SELECT hash, row FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                [self.model_name] + chunk))
+        return rows
+
+    def _matrix(self, min_rows):
+        if self.vectors is None or len(self.vectors) < min_rows:
+            rows = os.path.getsize(self.path) // (self.dim * self.dtype.itemsize)
+            self.vectors = np.memmap(self.path, dtype=self.dtype, mode="r", shape=(rows, self.dim))
+        return self.vectors
+
+    def _store(self, hashes, vectors):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT dim, rows, dtype FROM models WHERE model = ?", (self.model_name,)).fetchone()
+            if row is None:
+                self.conn.execute("INSERT INTO models (model, dim, dtype, rows) VALUES (?, ?, ?, 0)",
+                                  (self.model_name, vectors.shape[1], self.dtype.name))
+                row = (vectors.shape[1], 0, self.dtype.name)
+            self.dim, first = row[:2]
+            self.dtype = np.dtype(row[2])  # whoever created the cache chose its dtype
+            data = np.ascontiguousarray(vectors, dtype=self.dtype)
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, data.tobytes(), first * self.dim * self.dtype.itemsize)
+            finally:
+                os.close(fd)
+            # another process may have stored some of the same texts meanwhile; their rows here are just unused
+            self.conn.executemany("INSERT OR IGNORE INTO embeddings (model, hash, row) VALUES (?, ?, ?)",
+                                  ((self.model_name, key, first + i) for i, key in enumerate(hashes)))
+            self.conn.execute("UPDATE models SET rows = ? WHERE model = ?", (first + len(hashes), self.model_name))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def encode(self, texts, encode):
+        """Returns the float32 vectors of texts, calling encode (e.g. model.encode) only for the distinct texts that
+        are not cached yet, and caching what it returns."""
+        if not texts:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        hashes = [text_hash(text) for text in texts]
+        rows = self._rows(list(set(hashes)))
+        missing = {}
+        for text, key in zip(texts, hashes):
+            if key not in rows:
+                missing.setdefault(key, text)
+        if self.dim is None and rows:  # stored by another process since this one opened the cache
+            self.dim = self.conn.execute("SELECT dim FROM models WHERE model = ?", (self.model_name,)).fetchone()[0]
+        fresh = {}
+        if missing:
+            vectors = np.asarray(encode(list(missing.values())), dtype=np.float32)
+            self._store(list(missing), vectors)
+            fresh = dict(zip(missing, vectors.astype(self.dtype).astype(np.float32)))
+        result = np.empty((len(texts), self.dim), dtype=np.float32)
+        cached = [i for i, key in enumerate(hashes) if key in rows]
+        if cached:
+            cached_rows = [rows[hashes[i]] for i in cached]
+            result[cached] = self._matrix(max(cached_rows) + 1)[cached_rows]
+        for i, key in enumerate(hashes):
+            if key in fresh:
+                result[i] = fresh[key]
+        self.hits += len(cached)
+        self.misses += len(texts) - len(cached)
+        return result
+
+
+@lru_cache(maxsize=None)
+def get_embedding_cache(cache_dir, model_name, dtype=None):
+    """The EmbeddingCache of the current process for cache_dir and model_name, opened once."""
+    return EmbeddingCache(cache_dir, model_name, dtype)
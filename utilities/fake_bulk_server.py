@@ -0,0 +1,126 @@
+# A local stand-in for an OpenSearch cluster, for benchmarking the indexers without one: _bulk requests are parsed
+# and acknowledged item by item (with a configurable latency and 429 rejection rate), anything else gets a generic
+# acknowledgement. Usage: python fake_bulk_server.py --port 9299 --latency 0.05 --reject_rate 0.01
+import click
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+
+class BulkStats:
+    """What the server received, updated by the handler threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.docs = 0
+            self.rejections = 0
+            self.wire_bytes = 0  # as sent, i.e. gzipped when the client compresses
+            self.body_bytes = 0  # the NDJSON after decompression
+
+    def add(self, docs, rejections, wire_bytes, body_bytes):
+        with self.lock:
+            self.requests += 1
+            self.docs += docs
+            self.rejections += rejections
+            self.wire_bytes += wire_bytes
+            self.body_bytes += body_bytes
+
+    def as_dict(self):
+        with self.lock:
+            return {"requests": self.requests, "docs": self.docs, "rejections": self.rejections,
+                    "wire_bytes": self.wire_bytes, "body_bytes": self.body_bytes}
+
+
+class FakeBulkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real cluster
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _bulk(self, wire):
+        body = gzip.decompress(wire) if self.headers.get("Content-Encoding") == "gzip" else wire
+        items = []
+        lines = [line for line in body.split(b"\n") if line.strip()]
+        i = 0
+        while i < len(lines):
+            op_type, meta = next(iter(json.loads(lines[i]).items()))
+            if random.random() < self.server.reject_rate:
+                result = {"_id": meta.get("_id"), "status": 429,
+                          "error": {"type": "es_rejected_execution_exception", "reason": "rejected by the fake"}}
+            else:
+                result = {"_id": meta.get("_id"), "status": 200 if op_type == "delete" else 201, "result": "created"}
+            items.append({op_type: result})
+            i += 1 if op_type == "delete" else 2
+        rejections = sum(1 for item in items if next(iter(item.values()))["status"] == 429)
+        self.server.stats.add(len(items) - rejections, rejections, len(wire), len(body))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        return {"took": int(self.server.latency * 1000), "errors": rejections > 0, "items": items}
+
+    def do_POST(self):
+        wire = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.split("?")[0].endswith("/_bulk"):
+            self._reply(self._bulk(wire))
+        else:
+            self._reply({"acknowledged": True})
+
+    do_PUT = do_POST
+
+    def do_GET(self):
+        self._reply({"acknowledged": True})
+
+    def do_DELETE(self):
+        self._reply({"acknowledged": True})
+
+
+def start_server(port=0, latency=0.0, reject_rate=0.0):
+    """Starts the fake cluster on 127.0.0.1:port (0 picks a free port) in a daemon thread and returns the server;
+    server.server_address[1] is its port, server.stats what it received so far."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeBulkHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.reject_rate = reject_rate
+    server.stats = BulkStats()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@click.command()
+@click.option('--port', '-p', default=9299, show_default=True, help="Port to listen on (plain HTTP)")
+@click.option('--latency', default=0.0, show_default=True, help="Seconds added to every _bulk request")
+@click.option('--reject_rate', default=0.0, show_default=True, help="Share of the bulk items rejected with a 429")
+def main(port: int, latency: float, reject_rate: float):
+    server = start_server(port, latency, reject_rate)
+    logger.info(f"Fake _bulk endpoint on http://127.0.0.1:{server.server_address[1]}; point the indexers at it with "
+                f"OPENSEARCH_HOST=127.0.0.1 OPENSEARCH_PORT={server.server_address[1]} OPENSEARCH_USE_SSL=false")
+    try:
+        while True:
+            time.sleep(60)
+            logger.info(f"Received so far: {server.stats.as_dict()}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+# Offline embeddings of several product fields (name, shortDescription and features by default): a precompute job
+# encodes every field of every SKU in large length ordered batches into a memory mapped matrix, and the week4 indexer
+# pools the vectors of each SKU's fields into its document vector (mean, or weighted towards the name) instead of
+# running the model on the names inline.
+# Usage: python field_embeddings.py -s /workspace/datasets/product_data/products -o /workspace/models/field_embeddings
+import click
+import glob
+import json
+import logging
+import os
+from functools import lru_cache
+from time import perf_counter
+
+import numpy as np
+
+from embedding_backends import BACKENDS, DEFAULT_ONNX_DIR, cache_model_name, load_encoder
+from embedding_batches import DEFAULT_BATCH_SIZE, EmbeddingBatches
+from embedding_cache import get_embedding_cache
+from product_filters import FILTERS, PrefilteringExtractor, filter_names
+from product_snapshot import iter_snapshot_docs, list_snapshot_files
+from product_xml import iter_products, mappings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+DEFAULT_FIELDS = ("name", "shortDescription", "features")
+POOLINGS = ("mean", "weighted")
+# The name says what the product is; the description and the features add the words queries match it on
+DEFAULT_FIELD_WEIGHTS = {"name": 0.6, "shortDescription": 0.25, "features": 0.15}
+DEFAULT_CHUNK = 50000  # products whose fields are encoded together
+# The files of a store; meta.json is written last, so a store without it is incomplete
+META_FILE, SKUS_FILE, VECTORS_FILE, PRESENT_FILE = "meta.json", "skus.npy", "vectors.npy", "present.npy"
+
+
+def field_text(doc, field):
+    """The text of a field of an extracted product (its values joined, features being one value per feature), or ''."""
+    return " ".join(value.strip() for value in doc.get(field) or [] if value and value.strip())
+
+
+def default_field_weights(fields):
+    """DEFAULT_FIELD_WEIGHTS for the fields of a store it has a weight for; any other field weighs 1 / len(fields)."""
+    return {field: DEFAULT_FIELD_WEIGHTS.get(field, 1 / len(fields)) for field in fields}
+
+
+def parse_field_weights(spec, fields):
+    """The weights of fields from 'name=0.6,features=0.15,...'; fields left out weigh 0."""
+    weights = dict.fromkeys(fields, 0.0)
+    for item in spec.split(","):
+        field, _, weight = item.partition("=")
+        if field.strip() not in weights:
+            raise ValueError(f"Unknown field {field.strip()}, expected one of {list(fields)}")
+        weights[field.strip()] = float(weight)
+    return weights
+
+
+def pool(vectors, present, weights):
+    """Pools the field vectors of each product, shape (products, fields, dim), into one normalized float32 vector:
+    the weighted sum over the fields it has (present, shape (products, fields)). With normalized field vectors the
+    weights only need to be relative to each other."""
+    field_weights = present * np.asarray(weights, dtype=np.float32)
+    pooled = np.einsum("nf,nfd->nd", field_weights, np.asarray(vectors, dtype=np.float32))
+    return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+
+class FieldEmbeddings:
+    """A store written by precompute: the SKUs, sorted (skus.npy), the vectors of their fields (vectors.npy, shape
+    (SKUs, fields, dim)) and which fields each SKU has text for (present.npy), all memory mapped, plus meta.json."""
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.fields = self.meta["fields"]
+        self.skus = np.load(os.path.join(store_dir, SKUS_FILE), mmap_mode="r")
+        self.vectors = np.load(os.path.join(store_dir, VECTORS_FILE), mmap_mode="r")
+        self.present = np.load(os.path.join(store_dir, PRESENT_FILE), mmap_mode="r")
+
+    def weights(self, pooling="weighted", field_weights=None):
+        """The per field weights of pooling: equal for mean, field_weights (default default_field_weights of the
+        store's fields) for weighted."""
+        if pooling == "mean":
+            return [1.0] * len(self.fields)
+        if pooling == "weighted":
+            field_weights = field_weights or default_field_weights(self.fields)
+            return [field_weights.get(field, 0.0) for field in self.fields]
+        raise ValueError(f"Unknown pooling {pooling}, expected one of {POOLINGS}")
+
+    def rows(self, skus):
+        """The row of each SKU, -1 for the SKUs the store doesn't have."""
+        skus = np.asarray(skus, dtype=str)
+        if not len(self.skus):
+            return np.full(len(skus), -1)
+        rows = np.minimum(np.searchsorted(self.skus, skus), len(self.skus) - 1)
+        return np.where(self.skus[rows] == skus, rows, -1)
+
+    def pooled(self, skus, weights):
+        """(vectors, missing): the pooled vector of every SKU, and the positions of the SKUs not in the store, whose
+        vectors are left zero."""
+        rows = self.rows(skus)
+        found = np.flatnonzero(rows >= 0)
+        vectors = np.zeros((len(skus), self.vectors.shape[2]), dtype=np.float32)
+        if len(found):
+            found_rows = rows[found]
+            vectors[found] = pool(self.vectors[found_rows], self.present[found_rows], weights)
+        return vectors, np.flatnonzero(rows < 0)
+
+
+@lru_cache(maxsize=None)
+def get_field_embeddings(store_dir):
+    """The FieldEmbeddings of the current process for store_dir, opened once."""
+    return FieldEmbeddings(store_dir)
+
+
+def iter_docs(files, extractor, from_snapshot, columns):
+    """The products of files that extractor's filters accept, with the fields of columns."""
+    for file in files:
+        if from_snapshot:
+            docs = (doc for _, doc in iter_snapshot_docs(file, columns=columns) if extractor.accepts(doc))
+        else:
+            docs = (extractor(child) for child in iter_products(file))
+        for doc in docs:
+            if doc is not None:
+                yield doc
+
+
+def field_mappings(keys):
+    """The mappings of product_xml.py restricted to keys."""
+    selected = []
+    for idx in range(0, len(mappings), 2):
+        if mappings[idx + 1] in keys:
+            selected += mappings[idx:idx + 2]
+    return selected
+
+
+def precompute(files, store_dir, embedder, fields=DEFAULT_FIELDS, filters=(), from_snapshot=False, chunk=DEFAULT_CHUNK,
+               dtype="float32", meta=None):
+    """Writes the field vectors of the products of files to store_dir. A first pass collects the SKUs, so the matrix
+    can be laid out in SKU order; the second encodes each field of chunk products at a time with embedder (an
+    EmbeddingBatches). Returns the number of SKUs."""
+    product_filters = [FILTERS[name] for name in filter_names(names=("has_name",) + tuple(filters))]
+    filter_fields = {"sku"} | {key for product_filter in product_filters for key in product_filter.fields}
+    columns = sorted(filter_fields | set(fields))
+    start = perf_counter()
+    sku_extractor = PrefilteringExtractor(product_filters, field_mappings(filter_fields))
+    skus = np.unique(np.array([doc["sku"][0] for doc in iter_docs(files, sku_extractor, from_snapshot, columns)
+                               if doc["sku"]], dtype=str))
+    logger.info(f"Found {len(skus)} SKUs in {len(files)} files in {perf_counter() - start:.1f}s")
+    os.makedirs(store_dir, exist_ok=True)
+    if os.path.exists(os.path.join(store_dir, META_FILE)):
+        os.remove(os.path.join(store_dir, META_FILE))  # incomplete until it is written again
+    np.save(os.path.join(store_dir, SKUS_FILE), skus)
+    dim = np.asarray(embedder.model.encode(["dimension probe"])).shape[1]
+    vectors = np.lib.format.open_memmap(os.path.join(store_dir, VECTORS_FILE), mode="w+", dtype=dtype,
+                                        shape=(len(skus), len(fields), dim))
+    present = np.lib.format.open_memmap(os.path.join(store_dir, PRESENT_FILE), mode="w+", dtype=bool,
+                                        shape=(len(skus), len(fields)))
+
+    def encode_chunk(docs):
+        rows = np.searchsorted(skus, [doc["sku"][0] for doc in docs])
+        for f, field in enumerate(fields):
+            texts = [field_text(doc, field) for doc in docs]
+            has_text = np.flatnonzero([bool(text) for text in texts])
+            if len(has_text):
+                vectors[rows[has_text], f] = embedder.encode([texts[i] for i in has_text])
+                present[rows[has_text], f] = True
+
+    extractor = PrefilteringExtractor(product_filters, field_mappings(columns))
+    docs = []
+    done = 0
+    for doc in iter_docs(files, extractor, from_snapshot, columns):
+        if doc["sku"]:
+            docs.append(doc)
+        if len(docs) >= chunk:
+            encode_chunk(docs)
+            done += len(docs)
+            docs = []
+            logger.info(f"Encoded the fields of {done} products, {done / (perf_counter() - start):.0f} products/sec")
+    if docs:
+        encode_chunk(docs)
+    vectors.flush()
+    present.flush()
+    counts = present.sum(axis=0)
+    meta = dict(meta or {}, fields=list(fields), dim=int(dim), dtype=np.dtype(dtype).name, skus=int(len(skus)),
+                field_counts={field: int(count) for field, count in zip(fields, counts)})
+    with open(os.path.join(store_dir, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+    logger.info(f"Wrote the {', '.join(fields)} vectors of {len(skus)} SKUs to {store_dir} in "
+                f"{(perf_counter() - start) / 60:.1f} minutes ({embedder.texts} texts, {embedder.encoded} encoded); "
+                + ", ".join(f"{field} {count}" for field, count in meta["field_counts"].items()) + " SKUs have text")
+    return len(skus)
+
+
+@click.command()
+@click.option('--source_dir', '-s', required=True, help="XML files source directory")
+@click.option('--output_dir', '-o', required=True, help="Directory of the store (overwritten)")
+@click.option('--from_snapshot', is_flag=True, show_default=True, default=False, help="source_dir is a columnar product snapshot written by product_snapshot.py rather than the XML files.")
+@click.option('--field', 'fields', multiple=True, default=DEFAULT_FIELDS, show_default=True, help="Product fields to embed (repeatable)")
+@click.option('--reduced', is_flag=True, show_default=True, default=False, help="Only the products the indexer's --reduced keeps.")
+@click.option('--filter', 'filters', multiple=True, type=click.Choice(sorted(FILTERS)), help="Only the products this filter accepts (repeatable), as the indexer's --filter.")
+@click.option('--chunk', default=DEFAULT_CHUNK, show_default=True, help="Products whose fields are deduplicated, ordered by length and encoded together.")
+@click.option('--batch_size', default=DEFAULT_BATCH_SIZE, show_default=True, help="Texts per model batch")
+@click.option('--dtype', type=click.Choice(["float32", "float16"]), default="float32", show_default=True, help="How the vectors are stored (float16 halves the store)")
+@click.option('--embedding_backend', type=click.Choice(BACKENDS), default="torch", show_default=True, help="Encode with the PyTorch model or its ONNX export (see embedding_backends.py)")
+@click.option('--onnx_dir', default=DEFAULT_ONNX_DIR, show_default=True, help="Directory of the ONNX export, created if missing")
+@click.option('--model_threads', type=int, default=None, help="Threads the model may use to encode")
+@click.option('--embedding_cache', default=None, help="Directory of an embedding cache to take the vectors of texts seen before from (and add them to)")
+def main(source_dir: str, output_dir: str, from_snapshot: bool, fields, reduced: bool, filters, chunk: int, batch_size: int,
+         dtype: str, embedding_backend: str, onnx_dir: str, model_threads: int, embedding_cache: str):
+    unknown = set(fields) - set(mappings[1::2])
+    if unknown:
+        raise click.UsageError(f"Unknown product fields: {', '.join(sorted(unknown))}")
+    files = list_snapshot_files(source_dir) if from_snapshot else sorted(glob.glob(source_dir + "/*.xml"))
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    cache_model = cache_model_name(MODEL_NAME, embedding_backend)
+    cache = get_embedding_cache(embedding_cache, cache_model) if embedding_cache else None
+    embedder = EmbeddingBatches(load_encoder(embedding_backend, MODEL_NAME, model_threads, onnx_dir), batch_size, cache)
+    filters = (("reduced",) if reduced else ()) + tuple(filters)
+    precompute(files, output_dir, embedder, tuple(fields), filters, from_snapshot, chunk, dtype,
+               meta=dict(model=cache_model, backend=embedding_backend, filters=list(filters)))
+
+
+if __name__ == "__main__":
+    main()
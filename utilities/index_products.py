@@ -18,6 +18,25 @@ import json
 
 from time import perf_counter
 import concurrent.futures
+import contextlib
+import functools
+import itertools
+from collections import Counter
+import time
+
+from bulk_batcher import DEFAULT_MAX_BYTES, AdaptiveBatcher, log_bulk_summary
+from bulk_files import list_chunk_files, open_batcher
+from bulk_load import bulk_load
+from bulk_pipeline import run_pipeline
+from checkpoints import CheckpointJournal, resume_points
+from delta_manifest import DeltaManifest, content_hash, sku_hash
+from doc_schema import load_doc_schema
+from opensearch_client import DEFAULT_POOL_MAXSIZE, get_opensearch, get_worker_client, init_worker
+from product_snapshot import is_snapshot_file, iter_snapshot_docs, list_snapshot_files
+from product_filters import FILTERS, filter_names, get_prefiltering_extractor
+from product_xml import iter_product_range, iter_products
+from stage_metrics import StageTimer, report
+from work_schedule import log_utilization, plan_work, run_timed
 
 
 
@@ -25,138 +44,247 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logging.basicConfig(format='%(levelname)s:%(message)s')
 
-# NOTE: this is not a complete list of fields.  If you wish to add more, put in the appropriate XPath expression.
-#TODO: is there a way to do this using XPath/XSL Functions so that we don't have to maintain a big list?
-mappings =  [
-            "productId/text()", "productId",
-            "sku/text()", "sku",
-            "name/text()", "name",
-            "type/text()", "type",
-            "startDate/text()", "startDate",
-            "active/text()", "active",
-            "regularPrice/text()", "regularPrice",
-            "salePrice/text()", "salePrice",
-            "artistName/text()", "artistName",
-            "onSale/text()", "onSale",
-            "digital/text()", "digital",
-            "frequentlyPurchasedWith/*/text()", "frequentlyPurchasedWith",# Note the match all here to get the subfields
-            "accessories/*/text()", "accessories",# Note the match all here to get the subfields
-            "relatedProducts/*/text()", "relatedProducts",# Note the match all here to get the subfields
-            "crossSell/text()", "crossSell",
-            "salesRankShortTerm/text()", "salesRankShortTerm",
-            "salesRankMediumTerm/text()", "salesRankMediumTerm",
-            "salesRankLongTerm/text()", "salesRankLongTerm",
-            "bestSellingRank/text()", "bestSellingRank",
-            "url/text()", "url",
-            "categoryPath/*/name/text()", "categoryPath", # Note the match all here to get the subfields
-            "categoryPath/*/id/text()", "categoryPathIds", # Note the match all here to get the subfields
-            "categoryPath/category[last()]/id/text()", "categoryLeaf",
-            "count(categoryPath/*/name)", "categoryPathCount",
-            "customerReviewCount/text()", "customerReviewCount",
-            "customerReviewAverage/text()", "customerReviewAverage",
-            "inStoreAvailability/text()", "inStoreAvailability",
-            "onlineAvailability/text()", "onlineAvailability",
-            "releaseDate/text()", "releaseDate",
-            "shippingCost/text()", "shippingCost",
-            "shortDescription/text()", "shortDescription",
-            "shortDescriptionHtml/text()", "shortDescriptionHtml",
-            "class/text()", "class",
-            "classId/text()", "classId",
-            "subclass/text()", "subclass",
-            "subclassId/text()", "subclassId",
-            "department/text()", "department",
-            "departmentId/text()", "departmentId",
-            "bestBuyItemId/text()", "bestBuyItemId",
-            "description/text()", "description",
-            "manufacturer/text()", "manufacturer",
-            "modelNumber/text()", "modelNumber",
-            "image/text()", "image",
-            "condition/text()", "condition",
-            "inStorePickup/text()", "inStorePickup",
-            "homeDelivery/text()", "homeDelivery",
-            "quantityLimit/text()", "quantityLimit",
-            "color/text()", "color",
-            "depth/text()", "depth",
-            "height/text()", "height",
-            "weight/text()", "weight",
-            "shippingWeight/text()", "shippingWeight",
-            "width/text()", "width",
-            "longDescription/text()", "longDescription",
-            "longDescriptionHtml/text()", "longDescriptionHtml",
-            "features/*/text()", "features" # Note the match all here to get the subfields
-
-        ]
-
-def get_opensearch():
-
-    host = 'localhost'
-    port = 9200
-    auth = ('admin', 'admin')
-    client = OpenSearch(
-        hosts=[{'host': host, 'port': port}],
-        http_compress=True,  # enables gzip compression for request bodies
-        http_auth=auth,
-        # client_cert = client_cert_path,
-        # client_key = client_key_path,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_assert_hostname=False,
-        ssl_show_warn=False,
-        #ca_certs=ca_certs_path
-    )
-    return client
-
-
-def index_file(file, index_name, reduced=False):
-    docs_indexed = 0
-    ### W4: S1: Load the model.  # We do this here to avoid threading issues
-    client = get_opensearch()
-    logger.info(f'Processing file : {file}')
-    tree = etree.parse(file)
-    root = tree.getroot()
-    children = root.findall("./product")
-    docs = []
-    for child in children:
-        doc = {}
-        for idx in range(0, len(mappings), 2):
-            xpath_expr = mappings[idx]
-            key = mappings[idx + 1]
-            doc[key] = child.xpath(xpath_expr)
+
+def iter_docs(file, reduced=False, streaming=False, start=0, compact=False, byte_range=None, filters=(), timer=None):
+    """Yields (offset, doc) for the products in file that pass the filters, offset being the position of the product
+    in the file. The first start products are skipped without being extracted. file is either an XML file or a file of
+    a product snapshot (see product_snapshot.py). With compact, the docs are typed and compacted by doc_schema.
+
+    Besides --reduced, filters names more product_filters.FILTERS to apply. In XML files the filters are checked on
+    the few fields they need before the full extraction, which only runs for the products that pass.
+
+    With byte_range, only the products in that (start, stop) byte range of an XML file are read, as split by
+    work_schedule.plan_work, and offsets are positions within the range.
+
+    The time spent parsing and extracting (filtering and compaction included) is added to timer, a StageTimer.
+    """
+    timer = timer or StageTimer()
+    schema = load_doc_schema() if compact else None
+    # One per process and filter set, compiled from product_xml.mappings
+    extractor = get_prefiltering_extractor(filter_names(reduced, filters))
+    logger.info(f'Processing file : {file}' + (f' bytes {byte_range[0]}-{byte_range[1]}' if byte_range else ''))
+    snapshot = is_snapshot_file(file)
+    if snapshot:
+        products = timer.iter("parse", iter_snapshot_docs(file, start=start))
+    else:
+        if byte_range is not None:
+            children = timer.iter("parse", iter_product_range(file, *byte_range))
+        elif streaming:
+            children = timer.iter("parse", iter_products(file))
+        else:
+            with timer.time("parse"):
+                tree = etree.parse(file)
+                root = tree.getroot()
+                children = root.findall("./product")
+        products = enumerate(itertools.islice(children, start, None), start)
+    for offset, product in products:
         #print(doc)
-        if 'productId' not in doc or len(doc['productId']) == 0:
-            continue
-        if reduced and ('categoryPath' not in doc or 'Best Buy' not in doc['categoryPath'] or 'Movies & Music' in doc['categoryPath']):
-            continue
-        ### W4: S2: Encode the names
-        docs.append({'_index': index_name, '_id':doc['sku'][0], '_source' : doc})
-        #docs.append({'_index': index_name, '_source': doc})
-        docs_indexed += 1
-        if docs_indexed % 200 == 0:
-            bulk(client, docs, request_timeout=60)
-            #logger.info(f'{docs_indexed} documents indexed')
-            docs = []
-    if len(docs) > 0:
-        bulk(client, docs, request_timeout=60)
-        logger.info(f'{docs_indexed} documents indexed')
-    return docs_indexed
+        with timer.time("extract"):
+            if snapshot:
+                doc = product if extractor.accepts(product) else None
+            else:
+                doc = extractor(product)
+            if doc is None:
+                continue  # rejected by the filters, without extracting the other fields
+            if schema is not None:
+                doc = schema.compact(doc)
+        yield offset, doc
+
+
+def to_action(doc, index_name):
+    ### W4: S2: Encode the names
+    # sku is a text field, so it stays a list in compacted docs too
+    return {'_index': index_name, '_id':doc['sku'][0], '_source' : doc}
+    #return {'_index': index_name, '_source': doc}
+
+
+def iter_actions(file, index_name, reduced=False, streaming=False, compact=False, byte_range=None, filters=(), timer=None):
+    """Yields the bulk index actions for the products in file (or in its byte_range)."""
+    for _, doc in iter_docs(file, reduced, streaming, compact=compact, byte_range=byte_range, filters=filters, timer=timer):
+        yield to_action(doc, index_name)
+
+
+def index_file(file, index_name, reduced=False, streaming=False, bulk_options=None, checkpoint_path=None, start=0,
+               compact=False, byte_range=None, filters=()):
+    """Indexes the products of file, starting at product offset start. bulk_options are the AdaptiveBatcher keyword
+    arguments (max_bytes, raw_ndjson, gzip_level), plus to_ndjson to write chunk files to that directory instead. With
+    checkpoint_path, the offset of the first product not yet flushed is journaled after every bulk request, and the
+    file is marked done at the end. Returns the batcher's stats() plus the parse and extract times."""
+    ### W4: S1: Load the model.  # We do this here to avoid threading issues
+    client = get_worker_client()
+    timer = StageTimer()
+    journal = CheckpointJournal(checkpoint_path, index_name) if checkpoint_path else None
+    on_flush = functools.partial(journal.save, file) if journal else None
+    try:
+        name = os.path.splitext(os.path.basename(file))[0]
+        with open_batcher(client, bulk_options, name, on_flush=on_flush) as batcher:
+            for offset, doc in iter_docs(file, reduced, streaming, start, compact, byte_range, filters, timer):
+                batcher.add(to_action(doc, index_name), checkpoint=offset + 1)
+        if journal:
+            journal.save(file, 0, done=True)
+    finally:
+        if journal:
+            journal.close()
+    logger.info(f'{batcher.docs} documents indexed in {batcher.requests} bulk requests ({batcher.rejections} rejections, final batch size {batcher.batch_docs})')
+    stats = batcher.stats()
+    stats.update(timer.totals)
+    return stats
+
+
+def index_file_delta(file, index_name, manifest_path, reduced=False, streaming=False, bulk_options=None, compact=False,
+                     byte_range=None, filters=()):
+    """Like index_file, but only sends the documents whose content hash differs from the one in the delta manifest.
+
+    A SKU that appears more than once in the file gets one hash over all of its documents (see sku_hash): when any of
+    them changed, all of them are sent in file order, so the last one wins as it does in a full reindex. The file's
+    actions are therefore collected before anything is sent.
+
+    Returns the batcher's stats() (plus the parse and extract times) and the (sku, hash) pairs of every SKU in the
+    file, which the caller records in the manifest once the file is done.
+    """
+    client = get_worker_client()
+    timer = StageTimer()
+    actions = list(iter_actions(file, index_name, reduced, streaming, compact, byte_range, filters, timer))
+    doc_hashes = {}  # sku -> the content hashes of its documents, in file order
+    for action in actions:
+        doc_hashes.setdefault(action['_id'], []).append(content_hash(action['_source']))
+    hashes = {sku: sku_hash(sku_doc_hashes) for sku, sku_doc_hashes in doc_hashes.items()}
+    manifest = DeltaManifest(manifest_path, index_name)
+    try:
+        changed = {sku for sku, doc_hash in hashes.items() if manifest.lookup(sku) != doc_hash}
+    finally:
+        manifest.close()
+    with AdaptiveBatcher(client, **(bulk_options or {})) as batcher:
+        for action in actions:
+            if action['_id'] in changed:
+                batcher.add(action)
+    seen = list(hashes.items())
+    if batcher.failed_ids:
+        # An empty hash never matches, so the dead lettered documents are sent again by the next run
+        failed = set(batcher.failed_ids)
+        seen = [(sku, "" if sku in failed else doc_hash) for sku, doc_hash in seen]
+    logger.info(f'{batcher.docs} new or changed documents of {len(actions)} indexed in {batcher.requests} bulk requests ({batcher.rejections} rejections)')
+    stats = batcher.stats()
+    stats.update(timer.totals)
+    return stats, seen
+
+
+def delete_stale(manifest, index_name, bulk_options=None):
+    """Deletes the SKUs that are in the manifest but weren't in this run's dump, from both the index and the manifest.
+    The SKUs whose delete was dead lettered stay in the manifest, so the next run tries to delete them again."""
+    stale = manifest.stale_skus()
+    logger.info(f'Deleting {len(stale)} documents that are no longer in the dump')
+    with AdaptiveBatcher(get_worker_client(), initial_docs=1000, ignore_status=(404,), **(bulk_options or {})) as batcher:
+        for sku in stale:
+            batcher.add({'_op_type': 'delete', '_index': index_name, '_id': sku})
+    if batcher.failed_ids:
+        failed = set(batcher.failed_ids)
+        logger.warning(f'{len(failed)} stale documents could not be deleted and are kept in the manifest')
+        stale = [sku for sku in stale if sku not in failed]
+    manifest.remove(stale)
+    return len(stale)
+
 
 @click.command()
 @click.option('--source_dir', '-s', help='XML files source directory')
 @click.option('--index_name', '-i', default="bbuy_products", help="The name of the index to write to")
 @click.option('--workers', '-w', default=8, help="The name of the index to write to")
 @click.option('--reduced', is_flag=True, show_default=True, default=False, help="Removes music, movies, and merchandised products.")
-def main(source_dir: str, index_name: str, reduced: bool, workers: int):
-    logger.info(f"Indexing {source_dir} to {index_name} with {workers} workers, the reduced flag set to {reduced}.")
-    files = glob.glob(source_dir + "/*.xml")
-    docs_indexed = 0
+@click.option('--filter', 'filters', multiple=True, type=click.Choice(sorted(FILTERS)), help="Only index the products this filter accepts (repeatable). Filters are checked before the full field extraction.")
+@click.option('--from_snapshot', is_flag=True, show_default=True, default=False, help="source_dir is a columnar product snapshot written by product_snapshot.py rather than the XML files.")
+@click.option('--streaming', is_flag=True, show_default=True, default=False, help="Parse the XML files with iterparse, one product at a time, instead of loading each file into memory.")
+@click.option('--compact', is_flag=True, show_default=True, default=False, help="Type and compact the documents using the field types of conf/bbuy_products.json: numbers and booleans become native single values and empty fields are dropped.")
+@click.option('--split_mb', type=int, default=None, help="Split XML files bigger than this many MB into ranges of whole products of about that size, so workers share the big files. Files are always scheduled biggest first.")
+@click.option('--pipelined', is_flag=True, show_default=True, default=False, help="Parse in the worker processes and send from a separate pool of bulk senders, connected by a bounded queue.")
+@click.option('--senders', default=4, show_default=True, help="With --pipelined, the number of concurrent bulk senders.")
+@click.option('--queue_size', default=32, show_default=True, help="With --pipelined, the number of 200 document batches that may wait for a sender before the parsers block.")
+@click.option('--max_bulk_bytes', default=DEFAULT_MAX_BYTES, show_default=True, help="Byte budget of a bulk request; the document count per request adapts to the cluster's latency and rejections.")
+@click.option('--raw_bulk', is_flag=True, show_default=True, default=False, help="Encode the bulk bodies as NDJSON with orjson and send them with a raw _bulk request gzipped at --gzip_level, rather than with the client's json encoder and compression.")
+@click.option('--gzip_level', type=click.IntRange(0, 9), default=1, show_default=True, help="With --raw_bulk, the gzip level of the bulk bodies (0 sends them uncompressed).")
+@click.option('--to_ndjson', default=None, help="Write the bulk requests as gzipped _bulk chunk files to this directory instead of sending them, to be loaded with replay_bulk_files.py.")
+@click.option('--dead_letter', default=None, help="Append the documents that fail to index (after retrying the rejected ones) to this NDJSON file of _bulk actions instead of failing the run.")
+@click.option('--metrics_json', default=None, help="Write the run's per stage timings (parse, extract, serialize, bulk) and counters to this JSON file.")
+@click.option('--metrics_prom', default=None, help="Also write them to this file in the Prometheus text format.")
+@click.option('--bulk_load', 'bulk_load_mode', is_flag=True, show_default=True, default=False, help="Turn off refreshes and replicas on the index while loading, and restore them afterwards (even if indexing fails).")
+@click.option('--force_merge', type=int, default=None, help="With --bulk_load, force merge the index down to this many segments once all workers are done.")
+@click.option('--pool_maxsize', default=DEFAULT_POOL_MAXSIZE, show_default=True, help="Size of the connection pool of each worker's (or, with --pipelined, each sender's) OpenSearch client.")
+@click.option('--keep_alive/--no_keep_alive', default=True, show_default=True, help="Keep the pooled connections open between bulk requests.")
+@click.option('--checkpoint', 'checkpoint_path', default=None, help="Path of a SQLite journal of completed files and the last flushed product of each file in progress.")
+@click.option('--resume', is_flag=True, show_default=True, default=False, help="With --checkpoint, skip the files the journal marks done and restart the others from their last flushed batch. Without it the journal is reset.")
+@click.option('--delta_manifest', default=None, help="Path of a SQLite manifest of SKU content hashes. Only new or changed products are sent, and products missing from the dump are deleted. Delete the manifest when the index is recreated.")
+def main(source_dir: str, index_name: str, reduced: bool, workers: int, filters, from_snapshot: bool, streaming: bool, compact: bool, split_mb: int, pipelined: bool, senders: int, queue_size: int,
+         max_bulk_bytes: int, raw_bulk: bool, gzip_level: int, to_ndjson: str, dead_letter: str, metrics_json: str, metrics_prom: str, bulk_load_mode: bool, force_merge: int, pool_maxsize: int, keep_alive: bool, checkpoint_path: str,
+         resume: bool, delta_manifest: str):
+    if delta_manifest and pipelined:
+        raise click.UsageError("--delta_manifest can't be combined with --pipelined")
+    if checkpoint_path and (pipelined or delta_manifest):
+        raise click.UsageError("--checkpoint can't be combined with --pipelined or --delta_manifest")
+    if split_mb and (pipelined or checkpoint_path):
+        raise click.UsageError("--split_mb can't be combined with --pipelined or --checkpoint")
+    if resume and not checkpoint_path:
+        raise click.UsageError("--resume needs the --checkpoint journal of the run to resume")
+    if to_ndjson and (delta_manifest or bulk_load_mode):
+        raise click.UsageError("--to_ndjson can't be combined with --delta_manifest or --bulk_load, which need the cluster")
+    if to_ndjson and not resume and os.path.isdir(to_ndjson) and list_chunk_files(to_ndjson):
+        raise click.UsageError(f"{to_ndjson} already has chunk files; use an empty directory (or --resume the export)")
+    logger.info(f"Indexing {source_dir} to {index_name} with {workers} workers, the reduced flag set to {reduced}, streaming set to {streaming}.")
+    files = list_snapshot_files(source_dir) if from_snapshot else glob.glob(source_dir + "/*.xml")
+    stats = Counter()  # the bulk stats of all the workers
     start = perf_counter()
-    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
-        futures = [executor.submit(index_file, file, index_name, reduced) for file in files]
-        for future in concurrent.futures.as_completed(futures):
-            docs_indexed += future.result()
+    bulk_options = dict(max_bytes=max_bulk_bytes, raw_ndjson=raw_bulk, gzip_level=gzip_level, dead_letter=dead_letter)
+    split_bytes = split_mb * 1024 * 1024 if split_mb else None
+    records = []  # (worker pid, start, end) of every work item, for the utilization report
+    if to_ndjson:
+        os.makedirs(to_ndjson, exist_ok=True)
+        bulk_options['to_ndjson'] = to_ndjson
+    client_args = (pool_maxsize, keep_alive, not raw_bulk)
+    init_worker(*client_args)  # the main process' own client, for the index settings and deletes
+    load_mode = bulk_load(get_worker_client(), index_name, force_merge) if bulk_load_mode else contextlib.nullcontext()
+    with load_mode:
+        if pipelined:
+            produce = functools.partial(iter_actions, index_name=index_name, reduced=reduced, streaming=streaming, compact=compact,
+                                        filters=filters)
+            client_factory = functools.partial(get_opensearch, *client_args)
+            files = [item.file for item in plan_work(files)]  # biggest first
+            stats = run_pipeline(files, produce, client_factory, parsers=workers, senders=senders, queue_size=queue_size,
+                                        bulk_options=bulk_options)
+        elif delta_manifest:
+            manifest = DeltaManifest(delta_manifest, index_name)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                        initargs=client_args) as executor:
+                scheduled = time.time()
+                futures = [executor.submit(run_timed, index_file_delta, item.file, index_name, delta_manifest, reduced, streaming,
+                                           bulk_options, compact, item.byte_range, filters)
+                           for item in plan_work(files, split_bytes)]
+                for future in concurrent.futures.as_completed(futures):
+                    pid, item_start, item_end, (file_stats, seen) = future.result()
+                    records.append((pid, item_start, item_end))
+                    stats += file_stats
+                    manifest.record(seen)
+            log_utilization(records, scheduled, time.time())
+            # Only reached when every file went through, otherwise SKUs of the failed files would look deleted
+            delete_stale(manifest, index_name, bulk_options)
+            manifest.close()
+        else:
+            starts = dict.fromkeys(files, 0)
+            if checkpoint_path:
+                starts = resume_points(checkpoint_path, index_name, files, resume)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                        initargs=client_args) as executor:
+                scheduled = time.time()
+                futures = [executor.submit(run_timed, index_file, item.file, index_name, reduced, streaming, bulk_options,
+                                           checkpoint_path, starts[item.file], compact, item.byte_range, filters)
+                           for item in plan_work(starts, split_bytes)]
+                for future in concurrent.futures.as_completed(futures):
+                    pid, item_start, item_end, file_stats = future.result()
+                    records.append((pid, item_start, item_end))
+                    stats += file_stats
+            log_utilization(records, scheduled, time.time())
 
     finish = perf_counter()
-    logger.info(f'Done. Total docs: {docs_indexed} in {(finish - start)/60} minutes')
+    log_bulk_summary(stats, finish - start)
+    report(stats, finish - start, "index_products", metrics_json, metrics_prom)
+    logger.info(f'Done. Total docs: {stats["docs"]} in {(finish - start)/60} minutes')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,57 +1,68 @@
 # From Dmitiriy Shvadskiy https://github.com/dshvadskiy/search_with_machine_learning_course/blob/main/index_queries.py
 import click
 import pandas as pd
-from opensearchpy import OpenSearch
-from opensearchpy.helpers import bulk
 
+import contextlib
 import logging
+import os
+from time import perf_counter
+
+from bulk_batcher import DEFAULT_MAX_BYTES, log_bulk_summary
+from bulk_files import list_chunk_files, open_batcher
+from bulk_load import bulk_load
+from opensearch_client import get_opensearch
+from stage_metrics import StageTimer, report
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logging.basicConfig(format='%(levelname)s:%(message)s')
 
-def get_opensearch():
-
-    host = 'localhost'
-    port = 9200
-    auth = ('admin', 'admin')
-    client = OpenSearch(
-        hosts=[{'host': host, 'port': port}],
-        http_compress=True,  # enables gzip compression for request bodies
-        http_auth=auth,
-        # client_cert = client_cert_path,
-        # client_key = client_key_path,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_assert_hostname=False,
-        ssl_show_warn=False,
-        #ca_certs=ca_certs_path
-    )
-    return client
-
 @click.command()
 @click.option('--source_file', '-s', help='source csv file', required=True)
-def main(source_file):
-    index_name = 'bbuy_queries'
-    client = get_opensearch()
-    ds = pd.read_csv(source_file)
-    #print(ds.columns)
-    ds['click_time'] = pd.to_datetime(ds['click_time'])
-    ds['query_time'] = pd.to_datetime(ds['query_time'])
+@click.option('--index_name', '-i', default="bbuy_queries", help="The name of the index to write to")
+@click.option('--max_bulk_bytes', default=DEFAULT_MAX_BYTES, show_default=True, help="Byte budget of a bulk request; the document count per request adapts to the cluster's latency and rejections.")
+@click.option('--raw_bulk', is_flag=True, show_default=True, default=False, help="Encode the bulk bodies as NDJSON with orjson and send them with a raw _bulk request gzipped at --gzip_level, rather than with the client's json encoder and compression.")
+@click.option('--gzip_level', type=click.IntRange(0, 9), default=1, show_default=True, help="With --raw_bulk, the gzip level of the bulk bodies (0 sends them uncompressed).")
+@click.option('--to_ndjson', default=None, help="Write the bulk requests as gzipped _bulk chunk files to this directory instead of sending them, to be loaded with replay_bulk_files.py.")
+@click.option('--dead_letter', default=None, help="Append the documents that fail to index (after retrying the rejected ones) to this NDJSON file of _bulk actions instead of failing the run.")
+@click.option('--metrics_json', default=None, help="Write the run's per stage timings (parse, extract, serialize, bulk) and counters to this JSON file.")
+@click.option('--metrics_prom', default=None, help="Also write them to this file in the Prometheus text format.")
+@click.option('--bulk_load', 'bulk_load_mode', is_flag=True, show_default=True, default=False, help="Turn off refreshes and replicas on the index while loading, and restore them afterwards (even if indexing fails).")
+@click.option('--force_merge', type=int, default=None, help="With --bulk_load, force merge the index down to this many segments once loading is done.")
+def main(source_file, index_name, max_bulk_bytes, raw_bulk, gzip_level, to_ndjson, dead_letter, metrics_json, metrics_prom, bulk_load_mode, force_merge):
+    if to_ndjson and bulk_load_mode:
+        raise click.UsageError("--to_ndjson can't be combined with --bulk_load, which needs the cluster")
+    if to_ndjson and os.path.isdir(to_ndjson) and list_chunk_files(to_ndjson):
+        raise click.UsageError(f"{to_ndjson} already has chunk files; use an empty directory")
+    start = perf_counter()
+    client = get_opensearch(http_compress=not raw_bulk)
+    timer = StageTimer()
+    with timer.time("parse"):
+        ds = pd.read_csv(source_file)
+        #print(ds.columns)
+        ds['click_time'] = pd.to_datetime(ds['click_time'])
+        ds['query_time'] = pd.to_datetime(ds['query_time'])
     #print(ds.dtypes)
-    docs = []
-    for idx, row in ds.iterrows():
-        doc = {}
-        for col in ds.columns:
-            doc[col] = row[col]
-        docs.append({'_index': index_name , '_source': doc})
-        if idx % 300 == 0:
-            bulk(client, docs, request_timeout=60)
-            logger.info(f'{idx} documents indexed')
-            docs = []
-    if len(docs) > 0:
-        bulk(client, docs, request_timeout=60)
-    logger.info(f'Done indexing {ds.shape[0]} records')
+    load_mode = bulk_load(client, index_name, force_merge) if bulk_load_mode else contextlib.nullcontext()
+    bulk_options = dict(max_bytes=max_bulk_bytes, raw_ndjson=raw_bulk, gzip_level=gzip_level, dead_letter=dead_letter)
+    if to_ndjson:
+        os.makedirs(to_ndjson, exist_ok=True)
+        bulk_options['to_ndjson'] = to_ndjson
+    # query rows are tiny, so start with bigger batches than the products and let the byte budget cap them
+    with load_mode, open_batcher(client, bulk_options, index_name, initial_docs=1000, max_docs=20000) as batcher:
+        for idx, row in timer.iter("extract", ds.iterrows()):
+            with timer.time("extract"):
+                doc = {}
+                for col in ds.columns:
+                    doc[col] = row[col]
+            batcher.add({'_index': index_name , '_source': doc})
+            if idx % 100000 == 0:
+                logger.info(f'{idx} rows processed')
+    stats = batcher.stats()
+    stats.update(timer.totals)
+    log_bulk_summary(stats, perf_counter() - start)
+    report(stats, perf_counter() - start, "index_queries", metrics_json, metrics_prom)
+    logger.info(f'Done indexing {ds.shape[0]} records in {batcher.requests} bulk requests ({batcher.rejections} rejections, final batch size {batcher.batch_docs})')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,81 @@
+# Models the interactive query tools load once per process: each is registered with a loader, loaded on first use
+# and shared by every query after that. The registry keeps the load time of a model apart from the time of each call
+# made with it, so a slow first query shows up as loading rather than as prediction.
+import logging
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+
+class ModelRegistry:
+    """Models by name: the loader of each, the models loaded so far, their load times and the time of every call."""
+
+    def __init__(self):
+        self.loaders = {}
+        self.models = {}
+        self.load_seconds = {}
+        self.call_seconds = defaultdict(list)
+
+    def register(self, name, loader):
+        """Registers loader() -> model under name; a model loaded by an earlier loader of name is dropped, along with
+        its timings."""
+        self.loaders[name] = loader
+        self.models.pop(name, None)
+        self.call_seconds.pop(name, None)
+
+    def get(self, name):
+        """The model registered under name, loaded on the first call."""
+        if name not in self.models:
+            start = perf_counter()
+            self.models[name] = self.loaders[name]()
+            self.load_seconds[name] = perf_counter() - start
+            logger.info(f"Loaded {name} in {1000 * self.load_seconds[name]:.0f} ms")
+        return self.models[name]
+
+    @contextmanager
+    def timed(self, name):
+        """Times a call made with the model of name (loading it is not part of the call)."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.call_seconds[name].append(perf_counter() - start)
+
+    def last_call_ms(self, name):
+        return 1000 * self.call_seconds[name][-1] if self.call_seconds[name] else 0.0
+
+    def log_summary(self):
+        for name in self.models:
+            seconds = np.array(self.call_seconds[name]) * 1000
+            line = f"{name}: loaded in {1000 * self.load_seconds[name]:.0f} ms"
+            if len(seconds):
+                line += (f", {len(seconds)} calls, {seconds.mean():.2f} ms mean, {np.percentile(seconds, 50):.2f} ms p50, "
+                         f"{np.percentile(seconds, 95):.2f} ms p95")
+            logger.info(line)
+
+
+# The registry of the current process
+registry = ModelRegistry()
+
+
+def load_fasttext(path, quantized=False):
+    """Loads a fastText model. With quantized, a .bin classifier is loaded from its quantized .ftz version next to it
+    (a fraction of the size, so faster to load and lighter in memory), which is written on first use."""
+    import fasttext
+    if quantized and path.endswith(".bin"):
+        ftz_path = path[:-len(".bin")] + ".ftz"
+        if not os.path.exists(ftz_path):
+            start = perf_counter()
+            model = fasttext.load_model(path)
+            model.quantize(retrain=False)  # product quantization of the weights, without the training data
+            model.save_model(ftz_path)
+            logger.info(f"Wrote the quantized classifier {ftz_path} in {perf_counter() - start:.1f}s (a one off, counted in the load time)")
+        path = ftz_path
+    return fasttext.load_model(path)
@@ -0,0 +1,52 @@
+# The OpenSearch client of the indexers (utilities/index_products.py, index_queries.py, replay_bulk_files.py and
+# week4/utilities/index_products.py), and the one each worker process builds once and reuses
+import os
+
+from opensearchpy import OpenSearch
+
+DEFAULT_POOL_MAXSIZE = 10
+
+
+def default_host():
+    """(host, port) of the cluster: OPENSEARCH_HOST/PORT point the indexers elsewhere, e.g. at the fake cluster of
+    bench_indexing.py, and default to localhost:9200."""
+    return os.environ.get('OPENSEARCH_HOST', 'localhost'), int(os.environ.get('OPENSEARCH_PORT', 9200))
+
+
+def get_opensearch(pool_maxsize=DEFAULT_POOL_MAXSIZE, keep_alive=True, http_compress=True, host=None, port=None):
+    """A client of host:port (default: default_host()), over TLS unless OPENSEARCH_USE_SSL is false."""
+    if host is None:
+        host, port = default_host()
+    auth = ('admin', 'admin')
+    client = OpenSearch(
+        hosts=[{'host': host, 'port': port}],
+        http_compress=http_compress,  # enables gzip compression for request bodies (off for --raw_bulk, which gzips itself)
+        http_auth=auth,
+        # client_cert = client_cert_path,
+        # client_key = client_key_path,
+        use_ssl=os.environ.get('OPENSEARCH_USE_SSL', 'true') != 'false',
+        verify_certs=False,
+        ssl_assert_hostname=False,
+        ssl_show_warn=False,
+        #ca_certs=ca_certs_path
+        pool_maxsize=pool_maxsize,  # connections kept open per host
+        headers={'Connection': 'keep-alive' if keep_alive else 'close'},
+    )
+    return client
+
+
+# The client of the current process, so the TLS handshakes and connection pool are paid for once per worker rather
+# than once per file
+_worker_client = None
+
+
+def init_worker(pool_maxsize=DEFAULT_POOL_MAXSIZE, keep_alive=True, http_compress=True):
+    """Process pool initializer: builds the pooled client the worker reuses for every file it indexes."""
+    global _worker_client
+    _worker_client = get_opensearch(pool_maxsize, keep_alive, http_compress)
+
+
+def get_worker_client():
+    if _worker_client is None:
+        init_worker()
+    return _worker_client
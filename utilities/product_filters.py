@@ -0,0 +1,92 @@
+# Product filters that are evaluated before the full field extraction: each filter names the few fields it needs,
+# those are extracted first, and only the products every filter accepts get all of their fields extracted
+from collections import namedtuple
+from functools import lru_cache
+
+from product_xml import CompiledXPathExtractor, ProductExtractor, mappings
+
+# fields: the keys of product_xml.mappings the predicate reads; accept(doc) -> bool, doc holding at least those fields;
+# selective: whether it rejects enough products to be worth checking before the full extraction (the checks that
+# nearly every product passes are made on the extracted doc instead, rather than extracting their fields twice)
+ProductFilter = namedtuple("ProductFilter", ["fields", "accept", "selective"], defaults=(True,))
+
+
+def _has_product_id(doc):
+    return len(doc.get('productId', [])) > 0
+
+
+def _has_name(doc):
+    return len(doc.get('name', [])) > 0
+
+
+def _not_movies_and_music(doc):
+    category_path = doc.get('categoryPath', [])
+    return 'Best Buy' in category_path and 'Movies & Music' not in category_path
+
+
+def _is_active(doc):
+    return doc.get('active') == ['true']
+
+
+def _available_online(doc):
+    return doc.get('onlineAvailability') == ['true']
+
+
+# Filters selectable with --filter; has_product_id is always applied and reduced is what --reduced turns on
+FILTERS = {
+    "has_product_id": ProductFilter(("productId",), _has_product_id, selective=False),
+    "has_name": ProductFilter(("name",), _has_name, selective=False),  # the week4 indexer embeds the name
+    "reduced": ProductFilter(("categoryPath",), _not_movies_and_music),  # removes music, movies and merchandised products
+    "active": ProductFilter(("active",), _is_active),
+    "online": ProductFilter(("onlineAvailability",), _available_online),
+}
+
+
+def filter_names(reduced=False, names=()):
+    """The names of the filters to apply, in evaluation order, for the --reduced flag and --filter options."""
+    selected = ["has_product_id"]
+    if reduced:
+        selected.append("reduced")
+    selected.extend(name for name in names if name not in selected)
+    return tuple(selected)
+
+
+class PrefilteringExtractor:
+    """Wraps a ProductExtractor: the few fields the selective filters need are extracted first, each with its own
+    compiled XPath (for two or three fields that is cheaper than ProductExtractor's walk over all the children), and
+    the full extraction only runs for the products that pass. The other filters are checked on the extracted doc, and
+    without any selective filter there is no prefiltering at all. Rejected products return None.
+
+    The filters only ever see raw extracted values, so they behave the same whether or not docs are compacted later.
+    """
+
+    def __init__(self, filters, field_mappings=mappings):
+        self.filters = filters
+        self.extractor = ProductExtractor(field_mappings)
+        self.prefilters = [product_filter for product_filter in filters if product_filter.selective]
+        self.postfilters = [product_filter for product_filter in filters if not product_filter.selective]
+        needed = {key for product_filter in self.prefilters for key in product_filter.fields}
+        prefilter_mappings = []
+        for idx in range(0, len(field_mappings), 2):
+            if field_mappings[idx + 1] in needed:
+                prefilter_mappings += field_mappings[idx:idx + 2]
+        self.prefilter = CompiledXPathExtractor(prefilter_mappings) if self.prefilters else None
+
+    def accepts(self, doc):
+        return all(product_filter.accept(doc) for product_filter in self.filters)
+
+    def __call__(self, child):
+        if self.prefilter is not None:
+            prefiltered = self.prefilter(child)
+            if not all(product_filter.accept(prefiltered) for product_filter in self.prefilters):
+                return None
+        doc = self.extractor(child)
+        if not all(product_filter.accept(doc) for product_filter in self.postfilters):
+            return None
+        return doc
+
+
+@lru_cache(maxsize=None)
+def get_prefiltering_extractor(names):
+    """The PrefilteringExtractor for a tuple of filter names, built once per process."""
+    return PrefilteringExtractor([FILTERS[name] for name in names])
@@ -0,0 +1,120 @@
+# Converts the BestBuy product XML dump into a columnar snapshot (one Parquet or Arrow IPC file per XML file), so the
+# downstream jobs scan columns instead of re-parsing XML.
+# Usage: python product_snapshot.py -s /workspace/datasets/product_data/products -o /workspace/datasets/product_snapshot
+import click
+import concurrent.futures
+import glob
+import logging
+import os
+from time import perf_counter
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+from product_xml import ProductExtractor, iter_products, mappings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+SNAPSHOT_SUFFIXES = (".parquet", ".arrow")
+ROWS_PER_BATCH = 10000
+
+
+def snapshot_schema(field_mappings=mappings):
+    """One column per mapped field: count() expressions are doubles (as XPath returns them), everything else is a list
+    of strings, exactly like the extracted documents."""
+    fields = []
+    for idx in range(0, len(field_mappings), 2):
+        xpath_expr = field_mappings[idx]
+        key = field_mappings[idx + 1]
+        fields.append(pa.field(key, pa.float64() if xpath_expr.startswith("count(") else pa.list_(pa.string())))
+    return pa.schema(fields)
+
+
+def is_snapshot_file(path):
+    return path.endswith(SNAPSHOT_SUFFIXES)
+
+
+def list_snapshot_files(snapshot_dir):
+    return sorted(f for suffix in SNAPSHOT_SUFFIXES for f in glob.glob(os.path.join(snapshot_dir, "*" + suffix)))
+
+
+def iter_snapshot_batches(path, columns=None):
+    """Yields the record batches of a snapshot file, reading only columns (all if None) from a memory map."""
+    if path.endswith(".arrow"):
+        reader = ipc.open_file(pa.memory_map(path, "r"))
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield batch if columns is None else batch.select(columns)
+    else:
+        yield from pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=ROWS_PER_BATCH, columns=columns)
+
+
+def iter_snapshot_docs(path, columns=None, start=0):
+    """Yields (offset, doc) for every product of a snapshot file, offset being the product's position in the source
+    XML file. The docs have the same keys and values as ProductExtractor produces (restricted to columns)."""
+    offset = 0
+    for batch in iter_snapshot_batches(path, columns):
+        if offset + batch.num_rows <= start:
+            offset += batch.num_rows
+            continue
+        names = batch.schema.names
+        values = [column.to_pylist() for column in batch.columns]
+        for row in range(batch.num_rows):
+            if offset >= start:
+                yield offset, {name: column[row] for name, column in zip(names, values)}
+            offset += 1
+
+
+def convert_file(file, output_dir, file_format="parquet", compression="zstd"):
+    """Writes the products of one XML file to <output_dir>/<file name>.<format>, ROWS_PER_BATCH rows at a time."""
+    extractor = ProductExtractor()
+    schema = snapshot_schema()
+    stem = os.path.splitext(os.path.basename(file))[0]
+    output = os.path.join(output_dir, f"{stem}.{file_format}")
+    if file_format == "arrow":
+        writer = ipc.new_file(output, schema, options=ipc.IpcWriteOptions(compression=None))
+    else:
+        writer = pq.ParquetWriter(output, schema, compression=compression)
+    rows = 0
+    try:
+        docs = []
+        for child in iter_products(file):
+            docs.append(extractor(child))
+            if len(docs) >= ROWS_PER_BATCH:
+                writer.write_batch(pa.RecordBatch.from_pylist(docs, schema=schema))
+                rows += len(docs)
+                docs = []
+        if docs:
+            writer.write_batch(pa.RecordBatch.from_pylist(docs, schema=schema))
+            rows += len(docs)
+    finally:
+        writer.close()
+    logger.info(f'{file}: {rows} products written to {output}')
+    return rows
+
+
+@click.command()
+@click.option('--source_dir', '-s', required=True, help='XML files source directory')
+@click.option('--output_dir', '-o', required=True, help='Directory to write the snapshot to')
+@click.option('--format', '-f', 'file_format', type=click.Choice(["parquet", "arrow"]), default="parquet", show_default=True,
+              help="Parquet (compressed, smaller) or Arrow IPC (uncompressed, zero-copy memory mapped reads)")
+@click.option('--compression', default="zstd", show_default=True, help="Parquet compression codec")
+@click.option('--workers', '-w', default=8, help="The number of files to convert in parallel")
+def main(source_dir: str, output_dir: str, file_format: str, compression: str, workers: int):
+    files = glob.glob(source_dir + "/*.xml")
+    os.makedirs(output_dir, exist_ok=True)
+    logger.info(f"Converting {len(files)} files from {source_dir} to a snapshot of {file_format} files in {output_dir}")
+    start = perf_counter()
+    rows = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_file, file, output_dir, file_format, compression) for file in files]
+        for future in concurrent.futures.as_completed(futures):
+            rows += future.result()
+    logger.info(f'Done. Total products: {rows} in {(perf_counter() - start)/60} minutes')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# Shared BestBuy product XML handling for the indexers (utilities/index_products.py and week4/utilities/index_products.py)
+import io
+import re
+from collections import namedtuple
+
+from lxml import etree
+
+# NOTE: this is not a complete list of fields.  If you wish to add more, put in the appropriate XPath expression.
+#TODO: is there a way to do this using XPath/XSL Functions so that we don't have to maintain a big list?
+mappings =  [
+            "productId/text()", "productId",
+            "sku/text()", "sku",
+            "name/text()", "name",
+            "type/text()", "type",
+            "startDate/text()", "startDate",
+            "active/text()", "active",
+            "regularPrice/text()", "regularPrice",
+            "salePrice/text()", "salePrice",
+            "artistName/text()", "artistName",
+            "onSale/text()", "onSale",
+            "digital/text()", "digital",
+            "frequentlyPurchasedWith/*/text()", "frequentlyPurchasedWith",# Note the match all here to get the subfields
+            "accessories/*/text()", "accessories",# Note the match all here to get the subfields
+            "relatedProducts/*/text()", "relatedProducts",# Note the match all here to get the subfields
+            "crossSell/text()", "crossSell",
+            "salesRankShortTerm/text()", "salesRankShortTerm",
+            "salesRankMediumTerm/text()", "salesRankMediumTerm",
+            "salesRankLongTerm/text()", "salesRankLongTerm",
+            "bestSellingRank/text()", "bestSellingRank",
+            "url/text()", "url",
+            "categoryPath/*/name/text()", "categoryPath", # Note the match all here to get the subfields
+            "categoryPath/*/id/text()", "categoryPathIds", # Note the match all here to get the subfields
+            "categoryPath/category[last()]/id/text()", "categoryLeaf",
+            "count(categoryPath/*/name)", "categoryPathCount",
+            "customerReviewCount/text()", "customerReviewCount",
+            "customerReviewAverage/text()", "customerReviewAverage",
+            "inStoreAvailability/text()", "inStoreAvailability",
+            "onlineAvailability/text()", "onlineAvailability",
+            "releaseDate/text()", "releaseDate",
+            "shippingCost/text()", "shippingCost",
+            "shortDescription/text()", "shortDescription",
+            "shortDescriptionHtml/text()", "shortDescriptionHtml",
+            "class/text()", "class",
+            "classId/text()", "classId",
+            "subclass/text()", "subclass",
+            "subclassId/text()", "subclassId",
+            "department/text()", "department",
+            "departmentId/text()", "departmentId",
+            "bestBuyItemId/text()", "bestBuyItemId",
+            "description/text()", "description",
+            "manufacturer/text()", "manufacturer",
+            "modelNumber/text()", "modelNumber",
+            "image/text()", "image",
+            "condition/text()", "condition",
+            "inStorePickup/text()", "inStorePickup",
+            "homeDelivery/text()", "homeDelivery",
+            "quantityLimit/text()", "quantityLimit",
+            "color/text()", "color",
+            "depth/text()", "depth",
+            "height/text()", "height",
+            "weight/text()", "weight",
+            "shippingWeight/text()", "shippingWeight",
+            "width/text()", "width",
+            "longDescription/text()", "longDescription",
+            "longDescriptionHtml/text()", "longDescriptionHtml",
+            "features/*/text()", "features" # Note the match all here to get the subfields
+
+        ]
+
+
+def iter_products(file):
+    """Streams the top level <product> elements of a products file one at a time.
+
+    Each element is cleared (and dropped from the root) after the caller is done with it, so memory stays flat
+    regardless of the size of the file.
+    """
+    for _, elem in etree.iterparse(file, events=("end",), tag="product"):
+        parent = elem.getparent()
+        if parent is None or parent.getparent() is not None:
+            continue  # only direct children of the root, same as findall("./product")
+        yield elem
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def iter_product_range(file, byte_start, byte_stop):
+    """Streams the <product> elements in bytes [byte_start, byte_stop) of a products file, which must hold whole
+    top level products (see work_schedule.split_file), by parsing them under a stand-in root element."""
+    with open(file, "rb") as f:
+        f.seek(byte_start)
+        data = f.read(byte_stop - byte_start)
+    yield from iter_products(io.BytesIO(b"<products>" + data + b"</products>"))
+
+
+def extract_doc(child):
+    """The original extraction loop: evaluates every XPath string in mappings against the product. Kept as the reference
+    implementation for the extractors below."""
+    doc = {}
+    for idx in range(0, len(mappings), 2):
+        xpath_expr = mappings[idx]
+        key = mappings[idx + 1]
+        doc[key] = child.xpath(xpath_expr)
+    return doc
+
+
+def compile_mappings(field_mappings=mappings):
+    """Compiles the mappings once into (key, etree.XPath) pairs."""
+    return [(field_mappings[idx + 1], etree.XPath(field_mappings[idx])) for idx in range(0, len(field_mappings), 2)]
+
+
+class CompiledXPathExtractor:
+    """Same output as extract_doc, but the XPath expressions are only parsed once."""
+
+    def __init__(self, field_mappings=mappings):
+        self.compiled = compile_mappings(field_mappings)
+
+    def __call__(self, child):
+        return {key: xpath(child) for key, xpath in self.compiled}
+
+
+# A location step of the simple paths used in mappings: an element name or *, optionally restricted to the last match
+Step = namedtuple("Step", ["name", "last"])
+_STEP_RE = re.compile(r"^([A-Za-z_][\w.-]*|\*)(\[last\(\)\])?$")
+_COUNT_RE = re.compile(r"^count\((.+)\)$")
+
+
+def _parse_path(path):
+    steps = []
+    for part in path.split("/"):
+        match = _STEP_RE.match(part)
+        if match is None:
+            return None
+        steps.append(Step(match.group(1), match.group(2) is not None))
+    return steps
+
+
+def _parse_mapping(xpath_expr):
+    """Returns (steps, is_count) for the expressions the single pass extractor understands, or None."""
+    count_match = _COUNT_RE.match(xpath_expr)
+    if count_match:
+        steps = _parse_path(count_match.group(1))
+        is_count = True
+    elif xpath_expr.endswith("/text()"):
+        steps = _parse_path(xpath_expr[:-len("/text()")])
+        is_count = False
+    else:
+        return None
+    # The first step is matched against the product's children during the walk, so it has to be a plain element name
+    if not steps or steps[0].name == "*" or steps[0].last:
+        return None
+    return steps, is_count
+
+
+def _select(elem, steps):
+    nodes = [elem]
+    for step in steps:
+        selected = []
+        for node in nodes:
+            if step.name == "*":
+                matches = [c for c in node if isinstance(c.tag, str)]
+            else:
+                matches = [c for c in node if c.tag == step.name]
+            if step.last:
+                matches = matches[-1:]
+            selected.extend(matches)
+        nodes = selected
+    return nodes
+
+
+def _text_nodes(elem):
+    """The text() nodes of an element: its text plus the tails of its children."""
+    texts = [] if elem.text is None else [elem.text]
+    for c in elem:
+        if c.tail is not None:
+            texts.append(c.tail)
+    return texts
+
+
+class ProductExtractor:
+    """Fills every field of the mappings in a single walk over the product's children.
+
+    The mappings are compiled once: each expression is keyed on its first location step, so for every child of the
+    product only the fields that can match it are evaluated, against that child's (small) subtree. Expressions outside
+    of the simple path/text()/count() subset fall back to a precompiled etree.XPath. The output is the same as
+    extract_doc, apart from plain str instead of lxml's smart strings.
+    """
+
+    def __init__(self, field_mappings=mappings):
+        self.keys = []
+        self.count_keys = set()
+        self.by_tag = {}
+        self.fallback = []
+        for idx in range(0, len(field_mappings), 2):
+            xpath_expr = field_mappings[idx]
+            key = field_mappings[idx + 1]
+            self.keys.append(key)
+            parsed = _parse_mapping(xpath_expr)
+            if parsed is None:
+                self.fallback.append((key, etree.XPath(xpath_expr)))
+                continue
+            steps, is_count = parsed
+            if is_count:
+                self.count_keys.add(key)
+            self.by_tag.setdefault(steps[0].name, []).append((key, steps[1:], is_count))
+
+    def __call__(self, child):
+        doc = {key: (0.0 if key in self.count_keys else []) for key in self.keys}
+        for field_elem in child:
+            handlers = self.by_tag.get(field_elem.tag)
+            if handlers is None:
+                continue
+            for key, steps, is_count in handlers:
+                nodes = _select(field_elem, steps) if steps else [field_elem]
+                if is_count:
+                    doc[key] += len(nodes)
+                else:
+                    for node in nodes:
+                        doc[key].extend(_text_nodes(node))
+        for key, xpath in self.fallback:
+            doc[key] = xpath(child)
+        return doc
@@ -12,26 +12,37 @@ from urllib.parse import urljoin
 import pandas as pd
 import fileinput
 import logging
-import fasttext
 import re
 import pprint as pp
 import sys 
 import copy
-from sentence_transformers import SentenceTransformer
+from embedding_backends import BACKENDS, DEFAULT_ONNX_DIR, cache_model_name, get_encoder
+from embedding_cache import get_embedding_cache
+from model_registry import load_fasttext, registry
+from vector_quantization import INT8_CLIP, QUANTIZATIONS, index_quantization, quantize
 
 MODEL_NAME = "all-MiniLM-L6-v2"
 
 DEFAULT_MIN_CATEGORIES_PROBABILITY = 0.5
 DEFAULT_USE_MULTIPLE_CATEGORIES = False
+DEFAULT_CLASSIFIER_PATH = "/workspace/models/query_classifier_minq10000.bin"
+QUERY_CLASSIFIER = "query_classifier"
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logging.basicConfig(format='%(levelname)s:%(message)s')
 
-def create_vector_query(query: str, number_of_results: int = 10):
-    model = SentenceTransformer(MODEL_NAME)
-    embeddings = model.encode([query])
-    embedding = embeddings[0]
+def create_vector_query(query: str, number_of_results: int = 10, embedding_cache=None, quantization: str = "float32",
+                        clip: float = INT8_CLIP, embedding_backend: str = "torch", onnx_dir: str = DEFAULT_ONNX_DIR):
+    # The model (PyTorch or ONNX, see embedding_backends.py) is loaded on first use and kept for the following queries
+    encode = lambda texts: get_encoder(embedding_backend, MODEL_NAME, onnx_dir=onnx_dir).encode(texts)
+    if embedding_cache is not None:
+        # a repeated query is answered from the cache, without loading or running the model
+        embeddings = embedding_cache.encode([query], encode)
+    else:
+        embeddings = encode([query])
+    # quantized the way the indexer quantized the product vectors (an int8 index only takes byte vectors)
+    embedding = quantize(embeddings, quantization, clip)[0]
     query_obj = {
         "size": number_of_results,
         "query": {
@@ -230,13 +241,20 @@ def normalize_query(query: str) -> str:
     normalized_query = re.sub("\s+" , " ", normalized_query)
     return normalized_query
 
+def register_query_classifier(path: str = DEFAULT_CLASSIFIER_PATH, quantized: bool = False):
+    """Sets the fastText classifier categorize_query uses; it is loaded by the first query that needs it."""
+    registry.register(QUERY_CLASSIFIER, lambda: load_fasttext(path, quantized))
+
+register_query_classifier()
+
 def categorize_query(user_query: str, min_categories_probability: float = DEFAULT_MIN_CATEGORIES_PROBABILITY, use_multiple_categories: bool = DEFAULT_USE_MULTIPLE_CATEGORIES):
-    categorization_model = fasttext.load_model("/workspace/models/query_classifier_minq10000.bin")
+    categorization_model = registry.get(QUERY_CLASSIFIER)  # loaded once per process
     normalized_query = normalize_query(query=user_query)
     result = [] # list of categories
     summed_probabilities = 0.0
     if not use_multiple_categories:  # just one category in output desired
-        categories, probabilities = categorization_model.predict(normalized_query)
+        with registry.timed(QUERY_CLASSIFIER):
+            categories, probabilities = categorization_model.predict(normalized_query)
 #        print("all categories: {}".format(categories))
 #        print("all probabilities: {}".format(probabilities))
         if (categories is not None) and (len(categories)>0):
@@ -247,7 +265,8 @@ def categorize_query(user_query: str, min_categories_probability: float = DEFAUL
                 result = [category]
                 summed_probabilities += probability
     else:  # try using more than 1 category for output
-        predictions = categorization_model.predict(normalized_query, k=10)
+        with registry.timed(QUERY_CLASSIFIER):
+            predictions = categorization_model.predict(normalized_query, k=10)
         pp.pprint(predictions)
         categories = []
         probabilities = []
@@ -264,17 +283,19 @@ def categorize_query(user_query: str, min_categories_probability: float = DEFAUL
             summed_probabilities += probability
             if summed_probabilities > min_categories_probability:
                 break
-    print("user query: '{}' -> normalized query: '{}' -> predicted categories: {}, (summed) probability: {}, min_probability: {}". format(
-        user_query, normalized_query, result, summed_probabilities, min_categories_probability
+    print("user query: '{}' -> normalized query: '{}' -> predicted categories: {}, (summed) probability: {}, min_probability: {}, predicted in {:.2f} ms". format(
+        user_query, normalized_query, result, summed_probabilities, min_categories_probability, registry.last_call_ms(QUERY_CLASSIFIER)
     ))
     return result
 
 def search(client, user_query, index="bbuy_products", sort="_score", sortDir="desc", 
     min_categories_probability=DEFAULT_MIN_CATEGORIES_PROBABILITY, 
     use_multiple_categories=DEFAULT_USE_MULTIPLE_CATEGORIES,
-    use_vector=False):
+    use_vector=False, embedding_cache=None, quantization=("float32", INT8_CLIP), embedding_backend="torch",
+    onnx_dir=DEFAULT_ONNX_DIR):
     if use_vector:
-        query_obj = create_vector_query(query=user_query)
+        query_obj = create_vector_query(query=user_query, embedding_cache=embedding_cache, quantization=quantization[0],
+                                        clip=quantization[1], embedding_backend=embedding_backend, onnx_dir=onnx_dir)
     else:
         categories = categorize_query(user_query=user_query, min_categories_probability=min_categories_probability, use_multiple_categories=use_multiple_categories)
         query_obj = create_query(user_query, click_prior_query=None, filters=None, sort=sort, sortDir=sortDir,
@@ -324,6 +345,18 @@ if __name__ == "__main__":
                          help="The minimum prediction probability that all used query categories summed together must reach. If not provided, categories are not used.")
     general.add_argument("--use_multiple_categories", default=False, action="store_true")
     general.add_argument("--vector", default=False, action="store_true")
+    general.add_argument("--classifier", default=DEFAULT_CLASSIFIER_PATH,
+                         help="The fastText query classifier (.bin, or a quantized .ftz); it is loaded once, by the first query")
+    general.add_argument("--quantize_classifier", default=False, action="store_true",
+                         help="Load the quantized .ftz version of a .bin --classifier, writing it next to it if it isn't there yet")
+    general.add_argument("--embedding_cache",
+                         help="Directory of the on-disk embedding cache (e.g. the week4 indexer's --embedding_cache) to look query vectors up in and add them to.")
+    general.add_argument("--embedding_backend", choices=BACKENDS, default="torch",
+                         help="Encode the query with the PyTorch model or its ONNX export on onnxruntime (onnx_int8: with int8 weights)")
+    general.add_argument("--onnx_dir", default=DEFAULT_ONNX_DIR,
+                         help="Directory of the ONNX export, created on first use")
+    general.add_argument("--quantize", choices=QUANTIZATIONS,
+                         help="Quantize the query vectors like this (float16 or int8), for an index created with week4/conf/bbuy_products_float16.json (OpenSearch 2.13+) or _int8.json (2.9+). If not set, the quantization recorded in the index's mapping is used.")
     
     args = parser.parse_args()
     args, unknownargs = parser.parse_known_args()
@@ -340,6 +373,10 @@ if __name__ == "__main__":
     min_categories_probability = args.min_categories_probability
     use_multiple_categories = args.use_multiple_categories
     use_vector = args.vector
+    register_query_classifier(args.classifier, args.quantize_classifier)
+    embedding_cache = None
+    if args.embedding_cache:
+        embedding_cache = get_embedding_cache(args.embedding_cache, cache_model_name(MODEL_NAME, args.embedding_backend))
     base_url = "https://{}:{}/".format(host, port)
     opensearch = OpenSearch(
         hosts=[{'host': host, 'port': port}],
@@ -353,6 +390,10 @@ if __name__ == "__main__":
         ssl_show_warn=False,
     )
     index_name = args.index
+    quantization = ("float32", INT8_CLIP)
+    if use_vector:
+        recorded = index_quantization(opensearch, index_name)
+        quantization = (args.quantize, recorded[1] if recorded else INT8_CLIP) if args.quantize else (recorded or quantization)
     query_prompt = "\nEnter your query (type 'Exit' to exit or hit ctrl-c):"
     print(query_prompt)
     for line in sys.stdin:
@@ -360,5 +401,7 @@ if __name__ == "__main__":
         query = line.rstrip()
         if query.lower() == "exit":
             break
-        search(client=opensearch, user_query=query, index=index_name, min_categories_probability=min_categories_probability, use_multiple_categories=use_multiple_categories, use_vector=use_vector)
+        search(client=opensearch, user_query=query, index=index_name, min_categories_probability=min_categories_probability, use_multiple_categories=use_multiple_categories, use_vector=use_vector, embedding_cache=embedding_cache, quantization=quantization,
+               embedding_backend=args.embedding_backend, onnx_dir=args.onnx_dir)
         print(query_prompt)
+    registry.log_summary()  # the classifier's load time and predict times
@@ -0,0 +1,173 @@
+# Blue/green reindexing: builds a new generation of an index (<alias>_<timestamp>) next to the one being searched,
+# warms it with the most frequent queries of the query log, atomically points the alias at it and deletes the
+# generations past --keep. Searches go to the previous generation until the swap, so nothing sees a half-full index.
+# The indexer runs from its own directory: relative paths in the arguments after -- are resolved against it.
+# Usage: python reindex.py -s /workspace/datasets/product_data/products -- --reduced -w 8
+#        python reindex.py -s /workspace/datasets/product_data/products --mappings ../week4/conf/bbuy_products.json \
+#            --indexer ../week4/utilities/index_products.py --warm_queries 0
+import click
+import contextlib
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from time import perf_counter
+
+from opensearchpy.exceptions import NotFoundError
+
+from bulk_load import bulk_load
+from opensearch_client import get_opensearch
+from vector_quantization import check_cluster_version, mapping_quantization
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+UTILITIES_DIR = os.path.dirname(os.path.abspath(__file__))
+WARM_BATCH = 50  # queries per _msearch request
+
+
+def generation_name(alias):
+    return f"{alias}_{time.strftime('%Y%m%d%H%M%S')}"
+
+
+def list_generations(client, alias):
+    """The generation indices of alias, oldest first (the timestamps sort by name)."""
+    pattern = re.compile(re.escape(alias) + r"_\d{14}$")
+    try:
+        indices = client.indices.get(index=f"{alias}_*", allow_no_indices=True)
+    except NotFoundError:
+        return []
+    return sorted(name for name in indices if pattern.match(name))
+
+
+def alias_targets(client, alias):
+    """The indices alias points at (none if it doesn't exist or is the name of a plain index)."""
+    if not client.indices.exists_alias(name=alias):
+        return []
+    return sorted(client.indices.get_alias(name=alias))
+
+
+def create_generation(client, index_name, mappings_path):
+    with open(mappings_path) as f:
+        body = json.load(f)
+    try:
+        check_cluster_version(client, mapping_quantization(body))
+    except ValueError as e:
+        raise click.ClickException(f"{mappings_path}: {e}")
+    logger.info(f"Creating {index_name} with the settings and mappings of {mappings_path}")
+    client.indices.create(index=index_name, body=body)
+
+
+def run_indexer(indexer, source_dir, index_name, indexer_args):
+    """Runs the indexer script (index_products.py, week4's or any other taking -s and -i) into index_name, from its
+    own directory, like index-data.sh does. source_dir is made absolute; paths in indexer_args are resolved against
+    the indexer's directory."""
+    command = [sys.executable, os.path.basename(indexer), "-s", os.path.abspath(source_dir), "-i", index_name] + list(indexer_args)
+    logger.info(f"Running {' '.join(command)}")
+    returncode = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(indexer))).returncode
+    if returncode != 0:
+        raise click.ClickException(f"{indexer} exited with {returncode}; {index_name} was left in place for inspection "
+                                   f"and the alias was not moved")
+
+
+def popular_queries(client, queries_index, size):
+    """The size most frequent queries of the query log index."""
+    response = client.search(index=queries_index, body={
+        "size": 0, "aggs": {"queries": {"terms": {"field": "query.keyword", "size": size}}}})
+    return [bucket["key"] for bucket in response["aggregations"]["queries"]["buckets"]]
+
+
+def warm(client, index_name, queries):
+    """Replays queries against index_name with the search of query.py, so the first real searches after the swap
+    don't pay for loading the index's files and structures."""
+    # query.py loads the query classifier and embedding libraries, which the rest of the reindex doesn't need
+    from query import create_query
+    start = perf_counter()
+    errors = 0
+    for i in range(0, len(queries), WARM_BATCH):
+        body = []
+        for user_query in queries[i:i + WARM_BATCH]:
+            body.append({"index": index_name})
+            body.append(create_query(user_query, click_prior_query=None, filters=None,
+                                     source=["name", "shortDescription", "categoryPathIds"]))
+        response = client.msearch(body=body, request_timeout=120)
+        errors += sum(1 for result in response["responses"] if "error" in result)
+    logger.info(f"Warmed {index_name} with {len(queries)} queries in {perf_counter() - start:.1f}s ({errors} errors)")
+
+
+def swap_alias(client, alias, index_name, replace_index=False):
+    """Points alias at index_name only, in one atomic update_aliases call. With replace_index, a plain index named
+    alias (as created by index-data.sh) is deleted in the same call, since the alias can't exist next to it."""
+    actions = [{"remove": {"index": target, "alias": alias}} for target in alias_targets(client, alias)]
+    if client.indices.exists(index=alias) and not client.indices.exists_alias(name=alias):
+        if not replace_index:
+            raise click.ClickException(f"{alias} is an index, not an alias; rerun with --replace_index to delete it "
+                                       f"when the alias is swapped in (the new generation {index_name} is kept)")
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": index_name, "alias": alias}})
+    logger.info(f"Swapping {alias}: {actions}")
+    client.indices.update_aliases(body={"actions": actions})
+
+
+def delete_old_generations(client, alias, keep):
+    """Deletes all but the newest keep generations of alias, never one the alias points at."""
+    serving = set(alias_targets(client, alias))
+    generations = [name for name in list_generations(client, alias) if name not in serving]
+    old = generations[:max(len(generations) - max(keep - len(serving), 0), 0)]
+    for index_name in old:
+        logger.info(f"Deleting old generation {index_name}")
+        client.indices.delete(index=index_name)
+    return old
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option('--source_dir', '-s', required=True, help="The data the indexer reads (its -s)")
+@click.option('--alias', '-a', default="bbuy_products", show_default=True, help="The alias searches use")
+@click.option('--mappings', '-m', default=os.path.join(UTILITIES_DIR, "..", "conf", "bbuy_products.json"), help="Settings and mappings of the new index (default: conf/bbuy_products.json)")
+@click.option('--indexer', default=os.path.join(UTILITIES_DIR, "index_products.py"), help="The indexer script, run with -s source_dir -i <new index> and the arguments after -- (default: index_products.py). It runs from its own directory, so relative paths after -- (e.g. --checkpoint) are resolved against that directory, not the current one.")
+@click.option('--bulk_load/--no_bulk_load', 'bulk_load_mode', default=True, show_default=True, help="Turn off refreshes and replicas on the new index while the indexer runs.")
+@click.option('--force_merge', type=int, default=None, help="With --bulk_load, force merge the new index down to this many segments before warming it.")
+@click.option('--min_doc_ratio', default=0.9, show_default=True, help="Don't swap if the new index has fewer documents than this share of the one being replaced (0 to always swap).")
+@click.option('--queries_index', default="bbuy_queries", show_default=True, help="The query log index the warming queries come from")
+@click.option('--warm_queries', default=1000, show_default=True, help="The number of most frequent queries to replay against the new index before the swap (0 to skip warming).")
+@click.option('--keep', default=2, show_default=True, help="Generations to keep, counting the new one; the previous one stays around to point the alias back at.")
+@click.option('--replace_index', is_flag=True, show_default=True, default=False, help="If the alias name is a plain index (the in place setup of index-data.sh), delete it in the swap.")
+@click.argument('indexer_args', nargs=-1, type=click.UNPROCESSED)
+def main(source_dir: str, alias: str, mappings: str, indexer: str, bulk_load_mode: bool, force_merge: int,
+         min_doc_ratio: float, queries_index: str, warm_queries: int, keep: int, replace_index: bool, indexer_args):
+    if keep < 1:
+        raise click.UsageError("--keep must keep at least the new generation")
+    start = perf_counter()
+    client = get_opensearch()
+    if client.indices.exists(index=alias) and not alias_targets(client, alias) and not replace_index:
+        raise click.UsageError(f"{alias} is an index, not an alias; add --replace_index to delete it in the swap")
+    index_name = generation_name(alias)
+    create_generation(client, index_name, mappings)
+    load_mode = bulk_load(client, index_name, force_merge) if bulk_load_mode else contextlib.nullcontext()
+    with load_mode:
+        run_indexer(indexer, source_dir, index_name, indexer_args)
+    client.indices.refresh(index=index_name)
+
+    docs = client.count(index=index_name)["count"]
+    serving = docs
+    if client.indices.exists(index=alias):
+        serving = client.count(index=alias)["count"]
+    logger.info(f"{index_name} has {docs} documents, {alias} has {serving}")
+    if docs < min_doc_ratio * serving:
+        raise click.ClickException(f"{index_name} has fewer than {min_doc_ratio:.0%} of the {serving} documents of "
+                                   f"{alias}; not swapping (see --min_doc_ratio)")
+    if warm_queries > 0 and not client.indices.exists(index=queries_index):
+        logger.warning(f"No {queries_index} index to take warming queries from; swapping without warming")
+    elif warm_queries > 0:
+        warm(client, index_name, popular_queries(client, queries_index, warm_queries))
+    swap_alias(client, alias, index_name, replace_index)
+    delete_old_generations(client, alias, keep)
+    logger.info(f"{alias} now points at {index_name}; reindexed in {(perf_counter() - start)/60:.1f} minutes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Loads the _bulk chunk files written by index_products.py / index_queries.py --to_ndjson into one or more clusters.
+# The chunks are sent as they are on disk (already gzipped NDJSON), so nothing is parsed or encoded again.
+# Usage: python replay_bulk_files.py -s /workspace/bulk_files/products --host localhost:9200 --host otherhost:9200 -c 8
+import click
+import concurrent.futures
+import contextlib
+import gzip
+import logging
+import random
+import time
+from time import perf_counter
+
+from opensearchpy.exceptions import TransportError
+
+from bulk_files import list_chunk_files
+from bulk_ndjson import send_bulk_body, split_actions
+from opensearch_client import default_host, get_opensearch
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+
+def parse_host(value):
+    host, _, port = value.partition(":")
+    return host, int(port or 9200)
+
+
+def replay_chunk(client, path, request_timeout=120, max_retries=5, initial_backoff=1.0, gzip_level=1):
+    """Sends one chunk file and returns (docs indexed, bytes sent, docs failed).
+
+    Items rejected with a 429 (all of them, when the request itself is) are re-sent with exponential backoff, which is
+    the only time the chunk is decompressed. Any other item failure is logged and counted, except a 404 of a delete.
+    """
+    with open(path, "rb") as f:
+        body = f.read()
+    actions = None  # the encoded actions of the chunk, once some of them have to be re-sent
+    docs = failed = 0
+    attempt = 0
+    while True:
+        rejected = []
+        try:
+            if actions is None:
+                response = send_bulk_body(client, body, request_timeout=request_timeout, precompressed=True)
+            else:
+                response = send_bulk_body(client, b"".join(actions), gzip_level, request_timeout)
+        except TransportError as e:
+            if e.status_code != 429:
+                raise
+            if actions is None:
+                actions = split_actions(gzip.decompress(body))
+            rejected = list(range(len(actions)))
+        else:
+            for i, item in enumerate(response['items']):
+                op_type, result = next(iter(item.items()))
+                status = result.get('status', 500)
+                if status == 429:
+                    rejected.append(i)
+                elif status < 300 or (op_type == 'delete' and status == 404):
+                    docs += 1
+                else:
+                    failed += 1
+                    logger.warning(f"{path}: {op_type} of {result.get('_id')} failed with {status}: {result.get('error')}")
+        if not rejected:
+            return docs, len(body), failed
+        attempt += 1
+        if attempt > max_retries:
+            raise RuntimeError(f"{path}: {len(rejected)} document(s) still rejected after {max_retries} retries")
+        if actions is None:
+            actions = split_actions(gzip.decompress(body))
+        actions = [actions[i] for i in rejected]
+        backoff = initial_backoff * 2 ** (attempt - 1)
+        logger.debug(f"{path}: {len(actions)} documents rejected, retrying in {backoff:.1f}s")
+        time.sleep(backoff * random.uniform(0.5, 1.0))
+
+
+@click.command()
+@click.option('--source_dir', '-s', required=True, help="Directory of the chunk files written with --to_ndjson")
+@click.option('--host', 'hosts', multiple=True, help="host:port of a cluster to load; repeat the option to load several clusters at once. Default: OPENSEARCH_HOST:OPENSEARCH_PORT (localhost:9200), over TLS unless OPENSEARCH_USE_SSL is false, as for the indexers.")
+@click.option('--connections', '-c', default=4, show_default=True, help="The number of chunks sent concurrently to each cluster.")
+@click.option('--request_timeout', default=120, show_default=True, help="Timeout of each bulk request, in seconds.")
+def main(source_dir: str, hosts, connections: int, request_timeout: int):
+    files = list_chunk_files(source_dir)
+    hosts = hosts or ["%s:%d" % default_host()]
+    logger.info(f"Replaying {len(files)} chunk files from {source_dir} to {', '.join(hosts)} with {connections} connections each")
+    # one connection per concurrent chunk, and no compression: the chunks are gzipped already
+    clients = {host: get_opensearch(connections, http_compress=False, host=parse_host(host)[0], port=parse_host(host)[1])
+               for host in hosts}
+    totals = {host: [0, 0, 0] for host in hosts}
+    start = perf_counter()
+    # A pool per cluster, so a slow cluster holds on to its own connections only and every cluster loads at its speed
+    with contextlib.ExitStack() as stack:
+        executors = {host: stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=connections))
+                     for host in hosts}
+        futures = {executors[host].submit(replay_chunk, clients[host], file, request_timeout): host
+                   for host in hosts for file in files}
+        for future in concurrent.futures.as_completed(futures):
+            for i, value in enumerate(future.result()):
+                totals[futures[future]][i] += value
+    elapsed = perf_counter() - start
+    for host, (docs, size, failed) in totals.items():
+        logger.info(f"{host}: {docs} docs indexed, {failed} failed, {size / 1024 / 1024:.1f} MiB sent")
+    logger.info(f"Done in {elapsed / 60} minutes, {sum(t[1] for t in totals.values()) / 1024 / 1024 / elapsed:.1f} MiB/sec in total")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Per stage timing of the indexing jobs (XML parse, field extraction, embedding, serialization, bulk round trips),
+# so a slow run shows whether it is bound by our CPU or by the cluster. Workers accumulate seconds in a Counter
+# (keys <stage>_seconds) next to the bulk counters of AdaptiveBatcher.stats(), and the main process adds them up and
+# writes the summary as JSON and, optionally, in the Prometheus text format.
+import json
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+STAGES = ("parse", "extract", "embed", "serialize", "bulk")
+COUNTERS = ("docs", "bytes", "requests", "rejections", "retries", "failed")
+
+
+class StageTimer:
+    """Adds the seconds spent in each stage to totals[<stage>_seconds]."""
+
+    def __init__(self, totals=None):
+        self.totals = Counter() if totals is None else totals
+
+    @contextmanager
+    def time(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[f"{stage}_seconds"] += perf_counter() - start
+
+    def iter(self, stage, iterable):
+        """Yields from iterable, timing each step as stage, e.g. the parsing behind an iterparse generator."""
+        iterator = iter(iterable)
+        key = f"{stage}_seconds"
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.totals[key] += perf_counter() - start
+                return
+            self.totals[key] += perf_counter() - start
+            yield item
+
+
+def summarize(totals, elapsed, job):
+    """The run summary of the added up totals: seconds per stage (summed over the workers) and their share, the
+    counters, and the wall clock time and rate."""
+    staged = sum(totals[f"{stage}_seconds"] for stage in STAGES)
+    return {
+        "job": job,
+        "elapsed_seconds": elapsed,
+        "docs_per_sec": totals["docs"] / elapsed if elapsed > 0 else 0.0,
+        "stages": {stage: {"seconds": totals[f"{stage}_seconds"],
+                           "share": totals[f"{stage}_seconds"] / staged if staged else 0.0} for stage in STAGES},
+        "counters": {name: totals[name] for name in COUNTERS},
+    }
+
+
+def to_prometheus(summary):
+    """The summary in the Prometheus text exposition format, e.g. for the node exporter's textfile collector."""
+    job = summary["job"]
+    lines = ["# HELP indexing_stage_seconds_total Seconds spent in each indexing stage, summed over the workers.",
+             "# TYPE indexing_stage_seconds_total counter"]
+    for stage, values in summary["stages"].items():
+        lines.append(f'indexing_stage_seconds_total{{job="{job}",stage="{stage}"}} {values["seconds"]:.6f}')
+    for name, value in summary["counters"].items():
+        lines.append(f"# TYPE indexing_{name}_total counter")
+        lines.append(f'indexing_{name}_total{{job="{job}"}} {value}')
+    lines.append("# TYPE indexing_elapsed_seconds gauge")
+    lines.append(f'indexing_elapsed_seconds{{job="{job}"}} {summary["elapsed_seconds"]:.3f}')
+    return "\n".join(lines) + "\n"
+
+
+def report(totals, elapsed, job, json_path=None, prometheus_path=None):
+    """Logs the stage breakdown and writes the summary to json_path and/or prometheus_path."""
+    summary = summarize(totals, elapsed, job)
+    stages = ", ".join(f"{stage} {values['seconds']:.1f}s ({100 * values['share']:.0f}%)"
+                       for stage, values in summary["stages"].items() if values["seconds"])
+    logger.info(f"Stages (summed over workers): {stages}")
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(summary, f, indent=2)
+    if prometheus_path:
+        with open(prometheus_path, "w") as f:
+            f.write(to_prometheus(summary))
+    return summary
@@ -0,0 +1,74 @@
+# Reduced precision embeddings for the kNN index: float16, or int8 scalar quantization for byte vector fields. The
+# indexer and the query side have to quantize the same way, so an index records its quantization in the _meta of its
+# mapping (see week4/conf/bbuy_products_float16.json and bbuy_products_int8.json). Those mappings need a newer cluster
+# than the course's (OpenSearch 1.2.3, docker/docker-compose.yml), which only takes float32 embeddings
+import logging
+
+import numpy as np
+from opensearchpy.exceptions import NotFoundError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+QUANTIZATIONS = ("float32", "float16", "int8")
+# all-MiniLM-L6-v2 vectors are normalized, so their components are well inside [-0.5, 0.5]; int8 maps that range
+# onto [-127, 127] and clips the rare component beyond it
+INT8_CLIP = 0.5
+# The first OpenSearch versions whose k-NN plugin has the vector fields of the quantized mappings: lucene byte vectors
+# (data_type byte) and faiss's fp16 scalar quantizer
+MIN_OPENSEARCH_VERSIONS = {"float16": (2, 13), "int8": (2, 9)}
+
+
+def quantize(vectors, quantization="float32", clip=INT8_CLIP):
+    """The vectors as they are indexed (and queried) with quantization.
+
+    float16 vectors are rounded to float16 but returned as float32, since neither JSON encoder takes float16 arrays;
+    the index stores them in 16 bits (the faiss fp16 encoder of the mapping). int8 vectors are scaled so that +-clip
+    maps to +-127, rounded and clipped; cosine similarity doesn't depend on the scale.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if quantization == "float32":
+        return vectors
+    if quantization == "float16":
+        return vectors.astype(np.float16).astype(np.float32)
+    if quantization == "int8":
+        return np.clip(np.rint(vectors * (127 / clip)), -127, 127).astype(np.int8)
+    raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}")
+
+
+def index_quantization(client, index_name):
+    """(quantization, clip) recorded in the _meta.embedding_quantization of index_name's mapping (or of the index an
+    alias points at), ("float32", INT8_CLIP) if it records none, None if there is no such index."""
+    try:
+        response = client.indices.get_mapping(index=index_name)
+    except NotFoundError:
+        return None
+    for body in response.values():
+        meta = body.get("mappings", {}).get("_meta", {}).get("embedding_quantization") if isinstance(body, dict) else None
+        if meta:
+            return meta["type"], meta.get("clip", INT8_CLIP)
+    return "float32", INT8_CLIP
+
+
+def mapping_quantization(body):
+    """The quantization recorded in the _meta of an index body (settings and mappings), float32 if none."""
+    return body.get("mappings", {}).get("_meta", {}).get("embedding_quantization", {}).get("type", "float32")
+
+
+def check_cluster_version(client, quantization):
+    """Raises ValueError if the cluster is older than the OpenSearch version quantization needs (see
+    MIN_OPENSEARCH_VERSIONS). A cluster that doesn't report a version is assumed to be recent enough."""
+    required = MIN_OPENSEARCH_VERSIONS.get(quantization)
+    if required is None:
+        return
+    number = client.info().get("version", {}).get("number")
+    if number is None:
+        logger.warning(f"The cluster doesn't report its version; {quantization} embeddings need OpenSearch "
+                       f"{'.'.join(map(str, required))} or later")
+        return
+    version = tuple(int(part) for part in number.split("-")[0].split(".")[:2])
+    if version < required:
+        raise ValueError(f"{quantization} embeddings need OpenSearch {'.'.join(map(str, required))} or later (the k-NN "
+                         f"field of week4/conf/bbuy_products_{quantization}.json), the cluster runs {number}; index "
+                         f"float32 embeddings with week4/conf/bbuy_products.json instead")
@@ -0,0 +1,96 @@
+# Size-aware scheduling of the indexing work: the biggest work items are started first, and very large XML files are
+# split into ranges of whole products, so a single large file doesn't keep one worker busy long after the others are
+# done. Also reports how busy every worker process was.
+import logging
+import mmap
+import os
+import time
+from collections import defaultdict, namedtuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(format='%(levelname)s:%(message)s')
+
+PRODUCT_START = b"<product>"
+PRODUCT_END = b"</product>"
+
+# A unit of work: a whole file (byte_range None) or the products in bytes [start, stop) of an XML file
+WorkItem = namedtuple("WorkItem", ["file", "size", "byte_range"])
+
+
+def _is_top_level_start(m, pos, first):
+    """True if the <product> at pos follows the root's first product or a closing </product>, i.e. it is not nested."""
+    if pos == first:
+        return True
+    end = pos
+    while end > 0 and m[end - 1:end].isspace():
+        end -= 1
+    return m[max(0, end - len(PRODUCT_END)):end] == PRODUCT_END
+
+
+def split_file(file, max_bytes):
+    """Splits an XML products file into about equal byte ranges of at most ~max_bytes, cut at product boundaries.
+    Returns [(start, stop)], or None if the file has no products."""
+    with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        first = m.find(PRODUCT_START)
+        last = m.rfind(PRODUCT_END)
+        if first == -1 or last == -1:
+            return None
+        end = last + len(PRODUCT_END)
+        pieces = max(1, -(-(end - first) // max_bytes))
+        step = (end - first) / pieces
+        ranges = []
+        start = first
+        for i in range(1, pieces):
+            cut = m.find(PRODUCT_START, max(start + 1, int(first + i * step)))
+            while cut != -1 and cut < end and not _is_top_level_start(m, cut, first):
+                cut = m.find(PRODUCT_START, cut + 1)
+            if cut == -1 or cut >= end:
+                break
+            ranges.append((start, cut))
+            start = cut
+        ranges.append((start, end))
+        return ranges
+
+
+def plan_work(files, split_bytes=None):
+    """Returns the work items for files, biggest first. With split_bytes, XML files bigger than that are split into
+    product ranges of about that size; other files (e.g. snapshot files) are always whole items."""
+    items = []
+    for file in files:
+        size = os.path.getsize(file)
+        ranges = split_file(file, split_bytes) if split_bytes and size > split_bytes and file.endswith(".xml") else None
+        if ranges and len(ranges) > 1:
+            items.extend(WorkItem(file, stop - start, (start, stop)) for start, stop in ranges)
+        else:
+            items.append(WorkItem(file, size, None))
+    items.sort(key=lambda item: item.size, reverse=True)
+    if split_bytes:
+        logger.info(f'{len(files)} files planned as {len(items)} work items')
+    return items
+
+
+def run_timed(fn, *args):
+    """Runs fn(*args) in a worker and returns (worker pid, start time, end time, result) for log_utilization."""
+    start = time.time()
+    result = fn(*args)
+    return os.getpid(), start, time.time(), result
+
+
+def log_utilization(records, start, end):
+    """Logs, per worker process, the number of items it ran and the share of the run [start, end] (time.time()
+    values) it was busy for, and how long the run waited on its last worker after the first one ran out of work."""
+    if not records:
+        return
+    busy = defaultdict(float)
+    items = defaultdict(int)
+    last_end = defaultdict(float)
+    for pid, item_start, item_end in records:
+        busy[pid] += item_end - item_start
+        items[pid] += 1
+        last_end[pid] = max(last_end[pid], item_end)
+    elapsed = max(end - start, 1e-9)
+    for pid in sorted(busy, key=busy.get, reverse=True):
+        logger.info(f'Worker {pid}: {items[pid]} items, busy {busy[pid]:.1f}s ({100 * busy[pid] / elapsed:.0f}% of the run)')
+    logger.info(f'Workers {100 * sum(busy.values()) / (elapsed * len(busy)):.0f}% utilized on average; '
+                f'the tail after the first worker finished took {max(last_end.values()) - min(last_end.values()):.1f}s')
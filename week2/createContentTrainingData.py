@@ -6,6 +6,11 @@ import os
 import random
 import xml.etree.ElementTree as ET
 from pathlib import Path
+import sys
+
+# The product snapshot reader is shared with the top level utilities directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+from product_snapshot import iter_snapshot_docs, list_snapshot_files
 
 def transform_name(product_name):
     # IMPLEMENT
@@ -19,6 +24,7 @@ general = parser.add_argument_group("general")
 general.add_argument("--input", default=directory,  help="The directory containing product data")
 general.add_argument("--output", default="/workspace/datasets/fasttext/output.fasttext", help="the file to output to")
 general.add_argument("--label", default="id", help="id is default and needed for downsteam use, but name is helpful for debugging")
+general.add_argument("--snapshot", help="Read the products from a columnar snapshot directory (see utilities/product_snapshot.py) instead of the XML files in --input")
 
 # Consuming all of the product data, even excluding music and movies,
 # takes a few minutes. We can speed that up by taking a representative
@@ -68,12 +74,35 @@ def _label_filename(filename):
               labels.append((cat, transform_name(name)))
     return labels
 
+def _label_snapshot_file(filename):
+    # Same filters as _label_filename, but only the three columns needed are read from the snapshot
+    labels = []
+    for _, doc in iter_snapshot_docs(filename, columns=['name', 'categoryPathIds', 'categoryPath']):
+        if random.random() > sample_rate:
+            continue
+        ids = doc['categoryPathIds']
+        if (len(doc['name']) > 0 and len(ids) > 1 and
+            ids[0] == 'cat00000' and
+            ids[1] != 'abcat0600000'):
+              if names_as_labels:
+                  cat = doc['categoryPath'][-1].replace(' ', '_')
+              else:
+                  cat = ids[-1]
+              name = doc['name'][0].replace('\n', ' ')
+              labels.append((cat, transform_name(name)))
+    return labels
+
 if __name__ == '__main__':
-    files = glob.glob(f'{directory}/*.xml')
+    if args.snapshot:
+        files = list_snapshot_files(args.snapshot)
+        label_file = _label_snapshot_file
+    else:
+        files = glob.glob(f'{directory}/*.xml')
+        label_file = _label_filename
 
     print("Writing results to %s" % output_file)
     with multiprocessing.Pool() as p:
-        all_labels = tqdm(p.imap_unordered(_label_filename, files), total=len(files))
+        all_labels = tqdm(p.imap_unordered(label_file, files), total=len(files))
 
 
         with open(output_file, 'w') as output:
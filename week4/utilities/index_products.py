@@ -15,168 +15,306 @@ import json
 from time import perf_counter
 from typing import List
 import pprint as pp
+import sys
+import concurrent.futures
+import contextlib
+import functools
+from collections import Counter
+import time
+
+# The product XML handling is shared with the top level utilities directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "utilities"))
+from bulk_batcher import DEFAULT_MAX_BYTES, AdaptiveBatcher, log_bulk_summary
+from bulk_load import bulk_load
+from checkpoints import CheckpointJournal, resume_points
+from doc_schema import load_doc_schema
+from embedding_batches import DEFAULT_BATCH_SIZE, DEFAULT_WINDOW, EmbeddingBatches
+from embedding_backends import BACKENDS, DEFAULT_ONNX_DIR, cache_model_name, ensure_onnx_export, load_encoder
+from embedding_cache import get_embedding_cache
+from field_embeddings import POOLINGS, default_field_weights, get_field_embeddings, parse_field_weights
+from opensearch_client import DEFAULT_POOL_MAXSIZE, get_worker_client, init_worker
+from product_snapshot import is_snapshot_file, iter_snapshot_docs, list_snapshot_files
+from product_filters import FILTERS, filter_names, get_prefiltering_extractor
+from stage_metrics import StageTimer, report
+from vector_quantization import INT8_CLIP, QUANTIZATIONS, check_cluster_version, index_quantization, quantize
+from work_schedule import log_utilization, plan_work, run_timed
 
 MODEL_NAME = "all-MiniLM-L6-v2"
+WEEK4_MAPPINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "conf", "bbuy_products.json")
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logging.basicConfig(format='%(levelname)s:%(message)s')
 
 # IMPLEMENT ME: import the sentence transformers module!
-from sentence_transformers import SentenceTransformer
-
-# NOTE: this is not a complete list of fields.  If you wish to add more, put in the appropriate XPath expression.
-#TODO: is there a way to do this using XPath/XSL Functions so that we don't have to maintain a big list?
-mappings =  [
-            "productId/text()", "productId",
-            "sku/text()", "sku",
-            "name/text()", "name",
-            "type/text()", "type",
-            "startDate/text()", "startDate",
-            "active/text()", "active",
-            "regularPrice/text()", "regularPrice",
-            "salePrice/text()", "salePrice",
-            "artistName/text()", "artistName",
-            "onSale/text()", "onSale",
-            "digital/text()", "digital",
-            "frequentlyPurchasedWith/*/text()", "frequentlyPurchasedWith",# Note the match all here to get the subfields
-            "accessories/*/text()", "accessories",# Note the match all here to get the subfields
-            "relatedProducts/*/text()", "relatedProducts",# Note the match all here to get the subfields
-            "crossSell/text()", "crossSell",
-            "salesRankShortTerm/text()", "salesRankShortTerm",
-            "salesRankMediumTerm/text()", "salesRankMediumTerm",
-            "salesRankLongTerm/text()", "salesRankLongTerm",
-            "bestSellingRank/text()", "bestSellingRank",
-            "url/text()", "url",
-            "categoryPath/*/name/text()", "categoryPath", # Note the match all here to get the subfields
-            "categoryPath/*/id/text()", "categoryPathIds", # Note the match all here to get the subfields
-            "categoryPath/category[last()]/id/text()", "categoryLeaf",
-            "count(categoryPath/*/name)", "categoryPathCount",
-            "customerReviewCount/text()", "customerReviewCount",
-            "customerReviewAverage/text()", "customerReviewAverage",
-            "inStoreAvailability/text()", "inStoreAvailability",
-            "onlineAvailability/text()", "onlineAvailability",
-            "releaseDate/text()", "releaseDate",
-            "shippingCost/text()", "shippingCost",
-            "shortDescription/text()", "shortDescription",
-            "shortDescriptionHtml/text()", "shortDescriptionHtml",
-            "class/text()", "class",
-            "classId/text()", "classId",
-            "subclass/text()", "subclass",
-            "subclassId/text()", "subclassId",
-            "department/text()", "department",
-            "departmentId/text()", "departmentId",
-            "bestBuyItemId/text()", "bestBuyItemId",
-            "description/text()", "description",
-            "manufacturer/text()", "manufacturer",
-            "modelNumber/text()", "modelNumber",
-            "image/text()", "image",
-            "condition/text()", "condition",
-            "inStorePickup/text()", "inStorePickup",
-            "homeDelivery/text()", "homeDelivery",
-            "quantityLimit/text()", "quantityLimit",
-            "color/text()", "color",
-            "depth/text()", "depth",
-            "height/text()", "height",
-            "weight/text()", "weight",
-            "shippingWeight/text()", "shippingWeight",
-            "width/text()", "width",
-            "longDescription/text()", "longDescription",
-            "longDescriptionHtml/text()", "longDescriptionHtml",
-            "features/*/text()", "features" # Note the match all here to get the subfields
-
-        ]
-
-def get_opensearch():
-
-    host = 'localhost'
-    port = 9200
-    auth = ('admin', 'admin')
-    client = OpenSearch(
-        hosts=[{'host': host, 'port': port}],
-        http_compress=True,  # enables gzip compression for request bodies
-        http_auth=auth,
-        # client_cert = client_cert_path,
-        # client_key = client_key_path,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_assert_hostname=False,
-        ssl_show_warn=False,
-        #ca_certs=ca_certs_path
-    )
-    return client
-
-def index_documents(client, model, docs: List[dict], names: List[str]):
+# (embedding_backends imports it when the torch backend is used, so the ONNX workers don't load torch at all)
+
+# The embedding model of the current process, loaded once and used for every file it indexes, and the (backend,
+# threads, ONNX directory) it is loaded with
+_worker_model = None
+_worker_model_args = ("torch", None, DEFAULT_ONNX_DIR)
+
+def set_torch_threads(model_threads):
+    """Caps the intra-op threads torch uses for encoding, so that several workers don't oversubscribe the cores."""
+    import torch
+    torch.set_num_threads(model_threads)
+    torch.set_num_interop_threads(1)
+
+def init_embedding_worker(client_args=(), model_threads=None, backend="torch", onnx_dir=DEFAULT_ONNX_DIR, load_model=True):
+    """Process pool initializer of the parallel mode (and setup of the single process one): the pooled client as in
+    init_worker, the model's thread limit and the model itself (see embedding_backends.py), which is loaded here once
+    rather than for every file the worker is given. Without load_model (the vectors are precomputed) it is only loaded
+    if a product turns out to need it."""
+    global _worker_model, _worker_model_args
+    init_worker(*client_args)
+    # the tokenizers' own thread pool would be a second set of threads per worker
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_model_args = (backend, model_threads, onnx_dir)
+    if load_model:
+        get_worker_model()
+
+def get_worker_model():
+    global _worker_model
+    if _worker_model is None:
+        backend, model_threads, onnx_dir = _worker_model_args
+        if model_threads and backend == "torch":
+            set_torch_threads(model_threads)
+        _worker_model = load_encoder(backend, MODEL_NAME, model_threads, onnx_dir)
+        logger.info(f"Worker {os.getpid()} loaded {MODEL_NAME} on {backend}" + (f" with {model_threads} threads" if model_threads else ""))
+    return _worker_model
+
+def index_documents(batcher, embedder: EmbeddingBatches, docs: List[dict], names: List[str], checkpoints: List[int] = None,
+                    timer: StageTimer = None, quantization: str = "float32", clip: float = INT8_CLIP, field_embeddings=None,
+                    stats: Counter = None):
+    """Embeds and queues docs. field_embeddings: (FieldEmbeddings, field weights) to pool the precomputed vectors of
+    the docs' SKUs with, rather than encoding their names; the names of SKUs it doesn't have are still encoded."""
     logger.info("Transforming names to vectors")
-    embeddings = model.encode(names)
+    encoded = embedder.encoded
+    with (timer or StageTimer()).time("embed"):
+        if field_embeddings is not None:
+            store, weights = field_embeddings
+            embeddings, missing = store.pooled([doc["_id"] for doc in docs], weights)
+            if len(missing):
+                embedder.model = embedder.model or get_worker_model()
+                embeddings[missing] = embedder.encode([names[i] for i in missing])
+            if stats is not None:
+                stats.update(field_embedding_hits=len(docs) - len(missing), field_embedding_misses=len(missing))
+        else:
+            # Distinct names only, in length ordered model batches, and with an EmbeddingCache only the ones it hasn't seen
+            embeddings = embedder.encode(names)
+        embeddings = quantize(embeddings, quantization, clip)  # the cache and the store keep the float32 vectors
     for i in range(0, len(docs)):
         assert docs[i]["_source"]["name"][0] == names[i], f"vector embedded name {i} '{names[i]}' is not the one frome the doc: '{docs[i]['name']}'"
         docs[i]["_source"]["embedding"] = embeddings[i]
-    logger.info(f"{len(names)} names were transfomed to vectors.")
+    logger.info(f"{len(names)} names were transfomed to vectors ({embedder.encoded - encoded} went through the model).")
 
-    logger.info("Indexing")
-    bulk(client, docs, request_timeout=60)
-    logger.info(f"{len(docs)} documents with vectors were indexed.")
+    # The batcher sizes the bulk requests itself: with 384 floats per document the byte budget often flushes first
+    for i, doc in enumerate(docs):
+        batcher.add(doc, checkpoint=checkpoints[i] if checkpoints else None)
+    logger.info(f"{len(docs)} documents with vectors were queued for indexing.")
 
-def index_file(file, index_name, reduced=False):
+def index_file(file, index_name, reduced=False, bulk_options=None, checkpoint_path=None, start=0, compact=False, filters=(),
+               embed_options=None):
+    """Indexes the products of file with the embeddings of their names. embed_options: window (documents whose names
+    are encoded together), batch_size (texts per model batch), cache_dir / cache_dtype of an EmbeddingCache and
+    quantization / clip of the indexed vectors (see vector_quantization.py), and field_embeddings / pooling /
+    field_weights to pool the vectors of a field_embeddings.py store with instead of encoding the names."""
+    embed_options = embed_options or {}
+    window = embed_options.get('window', DEFAULT_WINDOW)
+    quantization = embed_options.get('quantization', "float32")
+    clip = embed_options.get('clip', INT8_CLIP)
+    field_store = embed_options.get('field_embeddings')
+    field_embeddings = None
+    if field_store:
+        store = get_field_embeddings(field_store)  # memory mapped once per process
+        field_embeddings = (store, store.weights(embed_options.get('pooling', "weighted"), embed_options.get('field_weights')))
     # IMPLEMENT ME: instantiate the sentence transformer model!
-    model = SentenceTransformer(MODEL_NAME)
+    # loaded once per process, not once per file, and with precomputed vectors only for the SKUs the store misses
+    model = None if field_embeddings else get_worker_model()
+    # The cache is opened once per process too
+    cache_dir = embed_options.get('cache_dir')
+    cache_model = cache_model_name(MODEL_NAME, embed_options.get('backend', "torch"))
+    cache = get_embedding_cache(cache_dir, cache_model, embed_options.get('cache_dtype')) if cache_dir else None
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    embedder = EmbeddingBatches(model, embed_options.get('batch_size', DEFAULT_BATCH_SIZE), cache)
 
+    embed_stats = Counter()
     docs_indexed = 0
-    client = get_opensearch()
-    logger.info(f'Processing file : {file}')
-    tree = etree.parse(file)
-    root = tree.getroot()
-    children = root.findall("./product")
-    docs = []
-    names = []
-    # IMPLEMENT ME: maintain the names array parallel to docs,
-    # and then embed them in bulk and add them to each doc,
-    # in the '_source' part of each docs entry, before calling bulk
-    # to index them 200 at a time. Make sure to clear the names array
-    # when you clear the docs array!
-    for child in children:
-        doc = {}
-        for idx in range(0, len(mappings), 2):
-            xpath_expr = mappings[idx]
-            key = mappings[idx + 1]
-            doc[key] = child.xpath(xpath_expr)
-        #print(doc)
-        if 'productId' not in doc or len(doc['productId']) == 0:
-            continue
-        if 'name' not in doc or len(doc['name']) == 0:
-            continue
-        if reduced and ('categoryPath' not in doc or 'Best Buy' not in doc['categoryPath'] or 'Movies & Music' in doc['categoryPath']):
-            continue
-        docs.append({'_index': index_name, '_id':doc['sku'][0], '_source' : doc})
-        #docs.append({'_index': index_name, '_source': doc})
-        names.append(doc["name"][0])
-        docs_indexed += 1
-        if docs_indexed % 200 == 0:
-            index_documents(client=client, model=model, docs=docs, names=names)
-            logger.info(f'Total: Now a total of {docs_indexed} documents are indexed for the current file.')
-            docs = []
-            names = []
-    if len(docs) > 0:
-        index_documents(client=client, model=model, docs=docs, names=names)
-        logger.info(f"Total: A total of {docs_indexed} documents was indexed for file '{file}'.")
-    return docs_indexed
+    client = get_worker_client()
+    timer = StageTimer()
+    # With a checkpoint journal, the offset of the first product not yet flushed is saved after every bulk request
+    journal = CheckpointJournal(checkpoint_path, index_name) if checkpoint_path else None
+    try:
+        on_flush = functools.partial(journal.save, file) if journal else None
+        # bulk_options are the AdaptiveBatcher keyword arguments (max_bytes, raw_ndjson, gzip_level)
+        batcher = AdaptiveBatcher(client, on_flush=on_flush, **(bulk_options or {}))
+        # Products without a name (nothing to embed) or rejected by --reduced / --filter are dropped before the full extraction
+        extractor = get_prefiltering_extractor(filter_names(reduced, ("has_name",) + tuple(filters)))
+        logger.info(f'Processing file : {file}')
+        if is_snapshot_file(file):
+            products = ((offset, doc) for offset, doc in iter_snapshot_docs(file, start=start) if extractor.accepts(doc))
+        else:
+            with timer.time("parse"):
+                tree = etree.parse(file)
+            root = tree.getroot()
+            children = root.findall("./product")
+            products = ((offset, extractor(child)) for offset, child in enumerate(children) if offset >= start)
+        products = timer.iter("extract", products)
+        schema = load_doc_schema(WEEK4_MAPPINGS_FILE) if compact else None
+        docs = []
+        names = []
+        checkpoints = []
+        # IMPLEMENT ME: maintain the names array parallel to docs,
+        # and then embed them in bulk and add them to each doc,
+        # in the '_source' part of each docs entry, before calling bulk
+        # to index them 200 at a time. Make sure to clear the names array
+        # when you clear the docs array!
+        # The names are encoded a window of documents at a time, independently of the bulk request size
+        for offset, doc in products:
+            #print(doc)
+            if doc is None:
+                continue
+            if schema is not None:
+                doc = schema.compact(doc)  # name and sku are text fields, so they stay lists
+            docs.append({'_index': index_name, '_id':doc['sku'][0], '_source' : doc})
+            #docs.append({'_index': index_name, '_source': doc})
+            names.append(doc["name"][0])
+            checkpoints.append(offset + 1)
+            docs_indexed += 1
+            if docs_indexed % window == 0:
+                index_documents(batcher=batcher, embedder=embedder, docs=docs, names=names, checkpoints=checkpoints, timer=timer,
+                                quantization=quantization, clip=clip, field_embeddings=field_embeddings, stats=embed_stats)
+                logger.info(f'Total: Now a total of {docs_indexed} documents are indexed for the current file.')
+                docs = []
+                names = []
+                checkpoints = []
+        if len(docs) > 0:
+            index_documents(batcher=batcher, embedder=embedder, docs=docs, names=names, checkpoints=checkpoints, timer=timer,
+                            quantization=quantization, clip=clip, field_embeddings=field_embeddings, stats=embed_stats)
+        batcher.flush()
+        if journal:
+            journal.save(file, 0, done=True)
+    finally:
+        if journal:
+            journal.close()
+    logger.info(f"Total: A total of {batcher.docs} documents was indexed for file '{file}' in {batcher.requests} bulk requests ({batcher.rejections} rejections).")
+    stats = batcher.stats()
+    stats.update(timer.totals)
+    stats.update(embed_stats)
+    stats.update(embedding_names=embedder.texts, embedding_distinct=embedder.distinct, embedding_encoded=embedder.encoded)
+    if cache:
+        stats.update(embedding_cache_hits=cache.hits - hits, embedding_cache_misses=cache.misses - misses)
+    return stats
 
 @click.command()
 @click.option('--source_dir', '-s', help='XML files source directory')
 @click.option('--index_name', '-i', default="bbuy_products", help="The name of the index to write to")
+@click.option('--workers', '-w', default=1, show_default=True, help="Index this many files at a time, each worker process loading the model once. 1 indexes the files one after another in this process.")
+@click.option('--model_threads', type=int, default=None, help="Threads the model may use to encode (torch or onnxruntime intra-op threads), per worker (default: the cores divided by --workers).")
+@click.option('--embedding_backend', type=click.Choice(BACKENDS), default="torch", show_default=True, help="Encode with the PyTorch model, or with its ONNX export (onnx_int8: with int8 quantized weights) on onnxruntime.")
+@click.option('--onnx_dir', default=DEFAULT_ONNX_DIR, show_default=True, help="Directory of the ONNX export, which is created on first use.")
 @click.option('--reduced', is_flag=True, show_default=True, default=False, help="Removes music, movies, and merchandised products.")
-def main(source_dir: str, index_name: str, reduced: bool):
-    logger.info(f"Indexing {source_dir} to {index_name}, the reduced flag set to {reduced}.")
-    files = glob.glob(source_dir + "/*.xml")
-    docs_indexed = 0
+@click.option('--filter', 'filters', multiple=True, type=click.Choice(sorted(FILTERS)), help="Only index the products this filter accepts (repeatable). Filters are checked before the full field extraction.")
+@click.option('--compact', is_flag=True, show_default=True, default=False, help="Type and compact the documents using the field types of week4/conf/bbuy_products.json: numbers and booleans become native single values and empty fields are dropped.")
+@click.option('--from_snapshot', is_flag=True, show_default=True, default=False, help="source_dir is a columnar product snapshot written by utilities/product_snapshot.py rather than the XML files.")
+@click.option('--embed_window', default=DEFAULT_WINDOW, show_default=True, help="Documents whose names are collected, deduplicated and encoded together.")
+@click.option('--embed_batch_size', default=DEFAULT_BATCH_SIZE, show_default=True, help="Names per model batch; the names of a window are batched by token length.")
+@click.option('--embedding_cache', default=None, help="Directory of an on-disk cache of the name vectors, so names embedded by an earlier run skip the model.")
+@click.option('--embedding_cache_dtype', type=click.Choice(["float32", "float16"]), default=None, help="How the vectors are stored in a new --embedding_cache (default float32; float16 halves its size). An existing cache keeps its own.")
+@click.option('--field_embeddings', default=None, help="Directory of the name, shortDescription and features vectors precomputed by utilities/field_embeddings.py: the vectors of each product's fields are pooled instead of encoding its name (which is only done for the SKUs the store misses).")
+@click.option('--pooling', type=click.Choice(POOLINGS), default="weighted", show_default=True, help="With --field_embeddings, average the field vectors or weight them by --field_weights.")
+@click.option('--field_weights', default=None, help="The relative weights of the store's fields for --pooling weighted, e.g. name=0.6,shortDescription=0.25,features=0.15; fields left out weigh 0. Default: those weights for the fields the store has, 1 / (number of fields) for any other.")
+@click.option('--quantize', type=click.Choice(QUANTIZATIONS), default=None, help="Index the embeddings as float16 or int8 byte vectors, for an index created with week4/conf/bbuy_products_float16.json or _int8.json, which need OpenSearch 2.13+ (float16) or 2.9+ (int8), not the course's 1.2.3. Default: what the index's mapping records, float32 if none.")
+@click.option('--max_bulk_bytes', default=DEFAULT_MAX_BYTES, show_default=True, help="Byte budget of a bulk request; the document count per request adapts to the cluster's latency and rejections.")
+@click.option('--raw_bulk', is_flag=True, show_default=True, default=False, help="Encode the bulk bodies as NDJSON with orjson (which serializes the numpy embeddings natively) and send them with a raw _bulk request.")
+@click.option('--gzip_level', type=click.IntRange(0, 9), default=1, show_default=True, help="With --raw_bulk, the gzip level of the bulk bodies (0 sends them uncompressed).")
+@click.option('--dead_letter', default=None, help="Append the documents that fail to index (after retrying the rejected ones) to this NDJSON file of _bulk actions instead of failing the run.")
+@click.option('--metrics_json', default=None, help="Write the run's per stage timings (parse, extract, embed, serialize, bulk) and counters to this JSON file.")
+@click.option('--metrics_prom', default=None, help="Also write them to this file in the Prometheus text format.")
+@click.option('--bulk_load', 'bulk_load_mode', is_flag=True, show_default=True, default=False, help="Turn off refreshes and replicas on the index while loading, and restore them afterwards (even if indexing fails).")
+@click.option('--force_merge', type=int, default=None, help="With --bulk_load, force merge the index down to this many segments once all files are done.")
+@click.option('--checkpoint', 'checkpoint_path', default=None, help="Path of a SQLite journal of completed files and the last flushed product of each file in progress.")
+@click.option('--resume', is_flag=True, show_default=True, default=False, help="With --checkpoint, skip the files the journal marks done and restart the others from their last flushed batch. Without it the journal is reset.")
+def main(source_dir: str, index_name: str, workers: int, model_threads: int, embedding_backend: str, onnx_dir: str, reduced: bool, filters, compact: bool, from_snapshot: bool, embed_window: int, embed_batch_size: int, embedding_cache: str, embedding_cache_dtype: str, field_embeddings: str, pooling: str, field_weights: str, quantize: str, max_bulk_bytes: int, raw_bulk: bool, gzip_level: int,
+         dead_letter: str, metrics_json: str, metrics_prom: str, bulk_load_mode: bool, force_merge: int, checkpoint_path: str, resume: bool):
+    if resume and not checkpoint_path:
+        raise click.UsageError("--resume needs the --checkpoint journal of the run to resume")
+    logger.info(f"Indexing {source_dir} to {index_name} with {workers} workers, the reduced flag set to {reduced}.")
+    files = list_snapshot_files(source_dir) if from_snapshot else glob.glob(source_dir + "/*.xml")
+    stats = Counter()
     start = perf_counter()
+    bulk_options = dict(max_bytes=max_bulk_bytes, raw_ndjson=raw_bulk, gzip_level=gzip_level, dead_letter=dead_letter)
+    embed_options = dict(window=embed_window, batch_size=embed_batch_size, cache_dir=embedding_cache,
+                         cache_dtype=embedding_cache_dtype)
+    if field_embeddings:
+        store = get_field_embeddings(field_embeddings)
+        weights = None  # mean pooling weighs the fields equally
+        if pooling == "weighted":
+            try:
+                weights = parse_field_weights(field_weights, store.fields) if field_weights else default_field_weights(store.fields)
+            except ValueError as e:
+                raise click.UsageError(f"--field_weights: {e}")
+        elif field_weights:
+            logger.warning("--field_weights is ignored with --pooling mean")
+        logger.info(f"Pooling ({pooling}) the {', '.join(store.fields)} vectors of {store.meta['skus']} SKUs from {field_embeddings}, "
+                    f"computed with {store.meta['model']}" + (f", weighted {weights}" if weights else ""))
+        embed_options.update(field_embeddings=field_embeddings, pooling=pooling, field_weights=weights)
+    client_args = (DEFAULT_POOL_MAXSIZE, True, not raw_bulk)
+    init_worker(*client_args)
+    # The vectors have to match the index's field type, and queries quantize by what the mapping records
+    recorded = index_quantization(get_worker_client(), index_name)
+    if quantize and recorded and recorded[0] != quantize:
+        raise click.UsageError(f"{index_name} was created for {recorded[0]} embeddings, not {quantize}")
+    if quantize:
+        try:
+            check_cluster_version(get_worker_client(), quantize)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+    quantization, clip = (quantize, recorded[1] if recorded else INT8_CLIP) if quantize else (recorded or ("float32", INT8_CLIP))
+    embed_options.update(quantization=quantization, clip=clip)
+    logger.info(f"Indexing {quantization} embeddings")
+    if model_threads is None and workers > 1:
+        model_threads = max(1, (os.cpu_count() or 1) // workers)
+    embed_options['backend'] = embedding_backend
+    ensure_onnx_export(embedding_backend, MODEL_NAME, onnx_dir)  # once, before the workers load it
 
-    for file in files:
-        docs_indexed += index_file(file, index_name, reduced)
+    starts = dict.fromkeys(files, 0)
+    if checkpoint_path:
+        starts = resume_points(checkpoint_path, index_name, files, resume)
+    load_mode = bulk_load(get_worker_client(), index_name, force_merge) if bulk_load_mode else contextlib.nullcontext()
+    with load_mode:
+        if workers > 1:
+            records = []  # (worker pid, start, end) of every file, for the utilization report
+            # The model is only loaded in the workers; this process just schedules the files, biggest first
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_embedding_worker,
+                                                        initargs=(client_args, model_threads, embedding_backend, onnx_dir,
+                                                                  not field_embeddings)) as executor:
+                scheduled = time.time()
+                futures = [executor.submit(run_timed, index_file, item.file, index_name, reduced, bulk_options,
+                                           checkpoint_path, starts[item.file], compact, filters, embed_options)
+                           for item in plan_work(starts)]
+                for future in concurrent.futures.as_completed(futures):
+                    pid, item_start, item_end, file_stats = future.result()
+                    records.append((pid, item_start, item_end))
+                    stats += file_stats
+            log_utilization(records, scheduled, time.time())
+        else:
+            init_embedding_worker(client_args, model_threads, embedding_backend, onnx_dir, not field_embeddings)
+            for file, file_start in starts.items():
+                stats += index_file(file, index_name, reduced, bulk_options, checkpoint_path, file_start, compact, filters,
+                                    embed_options)
 
     finish = perf_counter()
-    logger.info(f'Done. Total docs: {docs_indexed} in {(finish - start)/60} minutes')
+    log_bulk_summary(stats, finish - start)
+    logger.info(f'Embeddings: {stats["embedding_names"]} names, {stats["embedding_distinct"]} distinct within their windows, '
+                f'{stats["embedding_encoded"]} encoded by the model')
+    if field_embeddings:
+        logger.info(f'Field embeddings: {stats["field_embedding_hits"]} products pooled, {stats["field_embedding_misses"]} '
+                    f'not in the store and embedded by name')
+    if embedding_cache:
+        logger.info(f'Embedding cache: {stats["embedding_cache_hits"]} names cached, {stats["embedding_cache_misses"]} encoded')
+    report(stats, finish - start, "index_products_vectors", metrics_json, metrics_prom)
+    logger.info(f'Done. Total docs: {stats["docs"]} in {(finish - start)/60} minutes')
 
 if __name__ == "__main__":
     main()